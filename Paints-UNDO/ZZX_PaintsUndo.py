@@ -9,6 +9,8 @@ from .wd14tagger import default_interrogator
 from .diffusers_helper.k_diffusion import KDiffusionSampler
 from .diffusers_helper.cat_cond import unet_add_concat_conds
 from .diffusers_helper.code_cond import unet_add_coded_conds
+from .diffusers_vdm.text_cache import text_embedding_cache
+from .diffusers_vdm.latent_cache import latent_cache
 from transformers import CLIPTextModel, CLIPTokenizer
 from diffusers import AutoencoderKL, UNet2DConditionModel
 from diffusers.models.attention_processor import AttnProcessor2_0
@@ -117,19 +119,25 @@ class ZZX_PaintsUndo:
 
     def paints_undo_process(self, image, prompt, undo_steps, seed):
         print("Starting paints_undo_process method")
-        load_models_to_gpu([self.vae, self.text_encoder, self.unet])
+
+        # the text encoder is only moved when a prompt is not cached yet
+        if text_embedding_cache.missing(self.text_encoder, [prompt, ""]):
+            load_models_to_gpu([self.text_encoder])
+            self.encode_prompts([prompt, ""])
+
+        load_models_to_gpu([self.vae, self.unet])
+        conds, unconds = self.encode_prompts([prompt, ""])
 
         dtype = self.unet.dtype
 
         image = np.array(image)
-        concat_conds = torch.from_numpy(image).unsqueeze(0).to(self.vae.device, dtype=dtype) / 127.5 - 1.0
-        concat_conds = self.vae.encode(concat_conds.permute(0, 3, 1, 2)).latent_dist.mode() * self.vae.config.scaling_factor
+        concat_conds = torch.from_numpy(image).unsqueeze(0).to(dtype=dtype) / 127.5 - 1.0
+        concat_conds = concat_conds.permute(0, 3, 1, 2)
+        concat_conds = latent_cache.encode(self.vae, concat_conds, self.vae_encode)[0]['latent'][None]
+        concat_conds = concat_conds.to(self.vae.device)
 
         print(f"Concat_conds shape: {concat_conds.shape}")
 
-        conds = self.encode_prompt(prompt)
-        unconds = self.encode_prompt("")
-
         generator = torch.Generator(device=self.unet.device).manual_seed(seed)
 
         fs = torch.tensor([undo_steps], device=self.unet.device, dtype=torch.long)
@@ -163,9 +171,24 @@ class ZZX_PaintsUndo:
         
         return final_image
 
+    @torch.inference_mode()
+    def vae_encode(self, x):
+        # only called for images that are not in the latent cache
+        x = x.to(device=self.vae.device, dtype=self.vae.dtype)
+        return dict(latent=self.vae.encode(x).latent_dist.mode() * self.vae.config.scaling_factor)
+
     def encode_prompt(self, prompt):
+        return self.encode_prompts([prompt])[0]
+
+    def encode_prompts(self, prompts):
+        return text_embedding_cache.encode(
+            self.text_encoder, prompts, self.encode_prompts_uncached, device=self.unet.device
+        )
+
+    @torch.inference_mode()
+    def encode_prompts_uncached(self, prompts):
         text_inputs = self.tokenizer(
-            prompt,
+            prompts,
             padding="max_length",
             max_length=self.tokenizer.model_max_length,
             truncation=True,
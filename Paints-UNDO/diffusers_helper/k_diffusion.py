@@ -1,21 +1,59 @@
 import torch
 import numpy as np
 
+import safetensors.torch as sf
+
 from tqdm import tqdm
 
 
+def save_sampler_state(state, filename):
+    tensors = dict(x=state['x'], sigmas=state['sigmas'])
+    if state['old_denoised'] is not None:
+        tensors['old_denoised'] = state['old_denoised']
+    tensors = {k: v.detach().contiguous().cpu() for k, v in tensors.items()}
+    sf.save_file(tensors, filename, metadata=dict(step=str(state['step'])))
+    return
+
+
+def load_sampler_state(filename, device='cpu'):
+    tensors = sf.load_file(filename, device=str(device))
+    with sf.safe_open(filename, framework='pt') as f:
+        step = int(f.metadata()['step'])
+    return dict(x=tensors['x'], old_denoised=tensors.get('old_denoised', None), sigmas=tensors['sigmas'], step=step)
+
+
 @torch.no_grad()
-def sample_dpmpp_2m(model, x, sigmas, extra_args=None, callback=None, progress_tqdm=None):
-    """DPM-Solver++(2M)."""
+def sample_dpmpp_2m(model, x, sigmas, extra_args=None, callback=None, progress_tqdm=None,
+                    snapshot_steps=None, snapshot_callback=None, resume_state=None):
+    """DPM-Solver++(2M).
+
+    At every step index in `snapshot_steps`, `snapshot_callback` receives the solver state
+    (`x`, `old_denoised`, `sigmas`, `step`) before the model is evaluated at that step.
+    Passing such a state as `resume_state` continues sampling from it; `sigmas` is then the
+    remaining schedule, starting at the noise level of the snapshot, and may differ from the
+    schedule the snapshot was taken with.
+    """
     extra_args = {} if extra_args is None else extra_args
-    s_in = x.new_ones([x.shape[0]])
     sigma_fn = lambda t: t.neg().exp()
     t_fn = lambda sigma: sigma.log().neg()
     old_denoised = None
+    start = 0
+
+    if resume_state is not None:
+        start = resume_state['step']
+        x = resume_state['x'].to(sigmas.device)
+        sigmas = torch.cat([resume_state['sigmas'][:start].to(sigmas), sigmas])
+        if resume_state['old_denoised'] is not None:
+            old_denoised = resume_state['old_denoised'].to(x)
+
+    snapshot_steps = set() if snapshot_steps is None else set(snapshot_steps)
+    s_in = x.new_ones([x.shape[0]])
 
     bar = tqdm if progress_tqdm is None else progress_tqdm
 
-    for i in bar(range(len(sigmas) - 1)):
+    for i in bar(range(start, len(sigmas) - 1)):
+        if i in snapshot_steps and snapshot_callback is not None:
+            snapshot_callback({'x': x, 'old_denoised': old_denoised, 'sigmas': sigmas, 'step': i})
         denoised = model(x, sigmas[i] * s_in, **extra_args)
         if callback is not None:
             callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
@@ -61,10 +99,11 @@ class KModel:
         dists = log_sigma.to(self.log_sigmas.device) - self.log_sigmas[:, None]
         return dists.abs().argmin(dim=0).view(sigma.shape).to(sigma.device)
 
-    def get_sigmas_karras(self, n, rho=7.):
+    def get_sigmas_karras(self, n, rho=7., sigma_max=None):
+        sigma_max = self.sigma_max if sigma_max is None else sigma_max
         ramp = torch.linspace(0, 1, n)
         min_inv_rho = self.sigma_min ** (1 / rho)
-        max_inv_rho = self.sigma_max ** (1 / rho)
+        max_inv_rho = sigma_max ** (1 / rho)
         sigmas = (max_inv_rho + ramp * (min_inv_rho - max_inv_rho)) ** rho
         return torch.cat([sigmas, sigmas.new_zeros([1])])
 
@@ -98,10 +137,30 @@ class KDiffusionSampler:
             cross_attention_kwargs = None,
             same_noise_in_batch = False,
             progress_tqdm = None,
+            snapshot_steps = None,
+            snapshot_callback = None,
+            resume_state = None,
+            resume_steps = None,
     ):
 
         device = self.unet.device
 
+        # Resume
+
+        if resume_state is not None:
+            return self.resume(
+                resume_state,
+                resume_steps=resume_steps,
+                guidance_scale=guidance_scale,
+                batch_size=batch_size,
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                cross_attention_kwargs=cross_attention_kwargs,
+                progress_tqdm=progress_tqdm,
+                snapshot_steps=snapshot_steps,
+                snapshot_callback=snapshot_callback,
+            )
+
         # Sigmas
 
         sigmas = self.k_model.get_sigmas_karras(int(num_inference_steps/strength))
@@ -117,10 +176,56 @@ class KDiffusionSampler:
             noise = torch.randn(initial_latent.shape, generator=generator, device=device, dtype=self.unet.dtype)
 
         latents = initial_latent + noise * sigmas[0].to(initial_latent)
+        latents = latents.to(device)
+
+        return self.sample(
+            latents,
+            sigmas,
+            guidance_scale=guidance_scale,
+            batch_size=batch_size,
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            cross_attention_kwargs=cross_attention_kwargs,
+            progress_tqdm=progress_tqdm,
+            snapshot_steps=snapshot_steps,
+            snapshot_callback=snapshot_callback,
+        )
+
+    @torch.inference_mode()
+    def resume(self, resume_state, resume_steps=None, **kwargs):
+        # Remaining sigmas: the captured schedule, or a new Karras schedule of `resume_steps`
+        # steps from the noise level the snapshot was taken at.
+
+        device = self.unet.device
+        step = resume_state['step']
+
+        if resume_steps is None:
+            sigmas = resume_state['sigmas'][step:].to(device)
+        else:
+            sigma_start = resume_state['sigmas'][step].cpu()
+            sigmas = self.k_model.get_sigmas_karras(int(resume_steps), sigma_max=sigma_start).to(device)
+
+        return self.sample(None, sigmas, resume_state=resume_state, **kwargs)
+
+    @torch.inference_mode()
+    def sample(
+            self,
+            latents,
+            sigmas,
+            guidance_scale = 5.0,
+            batch_size = 1,
+            prompt_embeds = None,
+            negative_prompt_embeds = None,
+            cross_attention_kwargs = None,
+            progress_tqdm = None,
+            snapshot_steps = None,
+            snapshot_callback = None,
+            resume_state = None,
+    ):
+        device = self.unet.device
 
         # Batch
 
-        latents = latents.to(device)
         prompt_embeds = prompt_embeds.repeat(batch_size, 1, 1).to(device)
         negative_prompt_embeds = negative_prompt_embeds.repeat(batch_size, 1, 1).to(device)
 
@@ -140,6 +245,76 @@ class KDiffusionSampler:
 
         # Sample
 
-        results = sample_dpmpp_2m(self.k_model, latents, sigmas, extra_args=sampler_kwargs, progress_tqdm=progress_tqdm)
+        results = sample_dpmpp_2m(
+            self.k_model, latents, sigmas, extra_args=sampler_kwargs, progress_tqdm=progress_tqdm,
+            snapshot_steps=snapshot_steps, snapshot_callback=snapshot_callback, resume_state=resume_state
+        )
 
         return results
+
+    @torch.inference_mode()
+    def chain(
+            self,
+            initial_latent,
+            cross_attention_kwargs_list,
+            num_inference_steps = 25,
+            chain_strength = 0.5,
+            seed = None,
+            **kwargs
+    ):
+        # Warm-started chain: the first link is sampled from `initial_latent` with full steps,
+        # every later link is initialized from the previous result with `chain_strength`.
+
+        results = []
+        total_steps = 0
+
+        latent = initial_latent
+        strength = 1.0
+        steps = num_inference_steps
+
+        for cross_attention_kwargs in cross_attention_kwargs_list:
+            generator = None if seed is None else torch.Generator(device=self.unet.device).manual_seed(int(seed))
+            latent = self(
+                initial_latent=latent,
+                strength=strength,
+                num_inference_steps=steps,
+                batch_size=1,
+                generator=generator,
+                cross_attention_kwargs=cross_attention_kwargs,
+                **kwargs
+            )
+            results.append(latent)
+            total_steps += steps
+
+            strength = chain_strength
+            steps = max(1, int(round(num_inference_steps * chain_strength)))
+
+        return torch.cat(results, dim=0), total_steps
+
+
+@torch.inference_mode()
+def compare_chain_to_independent(sampler, initial_latent, cross_attention_kwargs_list, num_inference_steps=25,
+                                 chain_strength=0.5, seed=0, **kwargs):
+    chained, chained_steps = sampler.chain(
+        initial_latent, cross_attention_kwargs_list, num_inference_steps=num_inference_steps,
+        chain_strength=chain_strength, seed=seed, **kwargs
+    )
+
+    independent = []
+    for cross_attention_kwargs in cross_attention_kwargs_list:
+        generator = torch.Generator(device=sampler.unet.device).manual_seed(int(seed))
+        independent.append(sampler(
+            initial_latent=initial_latent, strength=1.0, num_inference_steps=num_inference_steps, batch_size=1,
+            generator=generator, cross_attention_kwargs=cross_attention_kwargs, **kwargs
+        ))
+    independent = torch.cat(independent, dim=0)
+
+    diff = (chained.float() - independent.float()).flatten(start_dim=1)
+    drift = diff.abs().mean(dim=1) / independent.float().flatten(start_dim=1).abs().mean(dim=1)
+
+    return dict(
+        independent_steps=num_inference_steps * len(cross_attention_kwargs_list),
+        chained_steps=chained_steps,
+        mean_abs_drift=diff.abs().mean(dim=1).tolist(),
+        relative_drift=drift.tolist(),
+    )
@@ -1,14 +1,15 @@
 import torch
-import xformers.ops
 import torch.nn.functional as F
 
 from torch import nn
 from einops import rearrange, repeat
 from functools import partial
-from diffusers_vdm.basics import zero_module, checkpoint, default, make_temporal_window
+from diffusers_vdm.basics import zero_module, checkpoint, default, make_temporal_window, folded_group_norm
+from diffusers_vdm.attention_backend import attention, select_backend
+from diffusers_vdm.token_merging import bipartite_soft_matching
 
 
-def sdp(q, k, v, heads):
+def sdp(q, k, v, heads, shape_class='spatial'):
     b, _, C = q.shape
     dim_head = C // heads
 
@@ -21,7 +22,7 @@ def sdp(q, k, v, heads):
         (q, k, v),
     )
 
-    out = xformers.ops.memory_efficient_attention(q, k, v)
+    out = attention(q, k, v, shape_class)
 
     out = (
         out.unsqueeze(0)
@@ -33,6 +34,142 @@ def sdp(q, k, v, heads):
     return out
 
 
+class CrossAttentionKVCache:
+    # K/V of the text and image contexts of every cross attention, reused across the steps of one run.
+    # Entries are keyed by module and context tensors, so each cfg branch (and the stacked batched pass)
+    # has its own; the contexts must be the same tensors at every step, as with prepared UNet conditions.
+    # The sampler raises max_entries_per_module to the number of condition sets of its run.
+
+    def __init__(self, max_entries_per_module=4):
+        self.max_entries_per_module = max_entries_per_module
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, module, context, context_image, compute):
+        module_entries = self.entries.setdefault(id(module), [])
+
+        for contexts, kv in module_entries:
+            if contexts[0] is context and contexts[1] is context_image:
+                self.hits += 1
+                return kv
+
+        self.misses += 1
+        kv = compute(context, context_image)
+        module_entries.append(((context, context_image), kv))
+        del module_entries[:-self.max_entries_per_module]
+        return kv
+
+    def memory_bytes(self):
+        return sum(
+            t.numel() * t.element_size()
+            for module_entries in self.entries.values() for _, kv in module_entries for t in kv
+        )
+
+    def clear(self):
+        self.entries.clear()
+        return
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=sum(len(v) for v in self.entries.values()),
+                    memory_bytes=self.memory_bytes())
+
+
+def set_cross_attention_kv_cache(model, kv_cache):
+    # kv_cache=None disables caching and lets the cached tensors go
+    for m in model.modules():
+        if isinstance(m, CrossAttention):
+            m.kv_cache = kv_cache
+    return
+
+
+# temporal attention has (b h w) sequences of t frames; up to this length they use short_sequence_attention
+short_sequence_max_length = 32
+# the weights of short_sequence_attention are computed in chunks of (b h w) of about this many bytes
+short_sequence_chunk_bytes = 256 * 1024 ** 2
+
+
+def short_sequence_attention(q, k, v, heads):
+    # q, k, v: (n, t, heads * dim_head) with a very large n and a small t. The heads stay a view of the
+    # channels, so there is no permute copy on the way in, and each chunk is written straight back into
+    # the (n, t, c) output.
+    n, t, c = q.shape
+    dim_head = c // heads
+    scale = dim_head ** -0.5
+
+    out = torch.empty_like(q)
+    chunk = max(1, short_sequence_chunk_bytes // (heads * t * t * q.element_size()))
+
+    for i in range(0, n, chunk):
+        q_, k_, v_ = (x[i:i + chunk].unflatten(-1, (heads, dim_head)) for x in (q, k, v))
+        weight = torch.einsum('nthd,nshd->nhts', q_, k_).mul_(scale).softmax(dim=-1)
+        out[i:i + chunk].unflatten(-1, (heads, dim_head)).copy_(torch.einsum('nhts,nshd->nthd', weight, v_))
+
+    return out
+
+
+def temporal_attention(q, k, v, heads):
+    # the short-sequence path or the general one, whichever was faster on the first call
+    if torch.is_grad_enabled() or q.shape[1] > short_sequence_max_length:
+        return sdp(q, k, v, heads, shape_class='temporal')
+
+    # q: (sequences, length, heads * dim_head); the faster path depends on all of them
+    key = (str(q.device), q.dtype, 'temporal_layout', q.shape[0], q.shape[1], heads, q.shape[2])
+    name = select_backend(key, dict(
+        short_sequence=partial(short_sequence_attention, q, k, v, heads),
+        sdp=partial(sdp, q, k, v, heads, shape_class='temporal'),
+    ), q.device, fallback='sdp')
+
+    if name == 'short_sequence':
+        return short_sequence_attention(q, k, v, heads)
+    return sdp(q, k, v, heads, shape_class='temporal')
+
+
+# the attention weights of previous_frame_window_attention are computed in query chunks of about this many bytes
+window_chunk_bytes = 512 * 1024 ** 2
+
+
+def attention_with_lse(q, k, v, scale):
+    # q: (..., lq, heads, dim_head), k, v: (..., lk, heads, dim_head); also returns the float log-sum-exp
+    # of the scores, (..., heads, lq), so attention over several K/V blocks can be merged afterwards
+    weight = torch.einsum('...qhd,...khd->...hqk', q, k).float().mul_(scale)
+    lse = torch.logsumexp(weight, dim=-1)
+    weight = weight.sub_(lse[..., None]).exp_().to(v.dtype)
+    return torch.einsum('...hqk,...khd->...qhd', weight, v), lse
+
+
+def previous_frame_window_attention(q, k, v, heads, video_length):
+    # Same result as sdp(q, make_temporal_window(k, 'prv'), make_temporal_window(v, 'prv')): every frame attends
+    # to its own tokens and to those of the previous frame. The two K/V blocks are attended separately, on views
+    # of k and v, and merged by their log-sum-exp, so the (b t, 2 hw, c) windows are never built.
+    # Frame 0 is its own previous frame, and attention over two copies of a block equals attention over one.
+    bt, n, c = q.shape
+    t = video_length
+    dim_head = c // heads
+    scale = dim_head ** -0.5
+
+    q, k, v = (x.view(bt // t, t, n, heads, dim_head) for x in (q, k, v))
+    out = torch.empty_like(q)
+    chunk = max(1, window_chunk_bytes // (bt * heads * n * 4 * 2))
+
+    for i in range(0, n, chunk):
+        q_ = q[:, :, i:i + chunk]
+        out_cur, lse_cur = attention_with_lse(q_, k, v, scale)
+        out[:, :1, i:i + chunk] = out_cur[:, :1]
+
+        if t < 2:
+            continue
+
+        out_prv, lse_prv = attention_with_lse(q_[:, 1:], k[:, :-1], v[:, :-1], scale)
+        lse_cur = lse_cur[:, 1:]
+        lse = torch.logaddexp(lse_cur, lse_prv)
+        w_cur = (lse_cur - lse).exp_().transpose(-1, -2)[..., None]
+        w_prv = (lse_prv - lse).exp_().transpose(-1, -2)[..., None]
+        out[:, 1:, i:i + chunk] = out_cur[:, 1:] * w_cur + out_prv * w_prv
+
+    return out.view(bt, n, c)
+
+
 class RelativePosition(nn.Module):
     """ https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py """
 
@@ -96,6 +233,8 @@ class CrossAttention(nn.Module):
             if image_cross_attention_scale_learnable:
                 self.register_parameter('alpha', nn.Parameter(torch.tensor(0.)) )
 
+        self.kv_cache = None
+
     def forward(self, x, context=None, mask=None):
         if self.is_temporal_attention:
             return self.temporal_forward(x, context=context, mask=mask)
@@ -110,7 +249,7 @@ class CrossAttention(nn.Module):
         k = self.to_k(x)
         v = self.to_v(x)
 
-        out = sdp(q, k, v, self.heads)
+        out = temporal_attention(q, k, v, self.heads)
 
         return self.to_out(out)
     
@@ -128,21 +267,24 @@ class CrossAttention(nn.Module):
             v = self.to_v(context)
 
             if self.temporal_window_for_spatial_self_attention:
+                if self.temporal_window_type == 'prv' and self.window_attention(q, k, v) == 'merged':
+                    return self.to_out(previous_frame_window_attention(q, k, v, self.heads, self.video_length))
+
                 k = make_temporal_window(k, t=self.video_length, method=self.temporal_window_type)
                 v = make_temporal_window(v, t=self.video_length, method=self.temporal_window_type)
         elif self.image_cross_attention:
             context, context_image = context
-            k = self.to_k(context)
-            v = self.to_v(context)
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
+            if self.kv_cache is not None:
+                k, v, k_ip, v_ip = self.kv_cache.get(self, context, context_image, self.context_kv)
+            else:
+                k, v, k_ip, v_ip = self.context_kv(context, context_image)
         else:
             raise NotImplementedError('Traditional prompt-only attention without IP-Adapter is illegal now.')
 
         out = sdp(q, k, v, self.heads)
 
         if k_ip is not None:
-            out_ip = sdp(q, k_ip, v_ip, self.heads)
+            out_ip = sdp(q, k_ip, v_ip, self.heads, shape_class='spatial_image')
 
             if self.image_cross_attention_scale_learnable:
                 out = out + self.image_cross_attention_scale * out_ip * (torch.tanh(self.alpha) + 1)
@@ -152,6 +294,25 @@ class CrossAttention(nn.Module):
         return self.to_out(out)
 
 
+    def window_attention(self, q, k, v):
+        # the merged previous-frame path saves the memory of the concatenated windows, but it has no fused
+        # kernel behind it, so it is only used where it also measured faster
+        if torch.is_grad_enabled():
+            return 'concat'
+
+        def concat():
+            return sdp(q, make_temporal_window(k, t=self.video_length, method='prv'),
+                       make_temporal_window(v, t=self.video_length, method='prv'), self.heads)
+
+        return select_backend((str(q.device), q.dtype, 'spatial_window', q.shape[1]), dict(
+            concat=concat,
+            merged=partial(previous_frame_window_attention, q, k, v, self.heads, self.video_length),
+        ), q.device, fallback='concat')
+
+    def context_kv(self, context, context_image):
+        return self.to_k(context), self.to_v(context), self.to_k_ip(context_image), self.to_v_ip(context_image)
+
+
 class BasicTransformerBlock(nn.Module):
 
     def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
@@ -171,7 +332,11 @@ class BasicTransformerBlock(nn.Module):
         self.checkpoint = checkpoint
 
 
-    def forward(self, x, context=None, mask=None, **kwargs):
+    def forward(self, x, context=None, mask=None, token_merge=None, **kwargs):
+        if token_merge is not None:
+            # inference only, nothing to checkpoint
+            return self._forward(x, context=context, mask=mask, token_merge=token_merge)
+
         ## implementation tricks: because checkpointing doesn't support non-tensor (e.g. None or scalar) arguments
         input_tuple = (x,)      ## should not be (x), otherwise *input_tuple will decouple x into multiple arguments
         if context is not None:
@@ -182,8 +347,12 @@ class BasicTransformerBlock(nn.Module):
         return checkpoint(self._forward, input_tuple, self.parameters(), self.checkpoint)
 
 
-    def _forward(self, x, context=None, mask=None):
-        x = self.attn1(self.norm1(x), context=context if self.disable_self_attn else None, mask=mask) + x
+    def _forward(self, x, context=None, mask=None, token_merge=None):
+        if token_merge is None:
+            x = self.attn1(self.norm1(x), context=context if self.disable_self_attn else None, mask=mask) + x
+        else:
+            merge, unmerge = token_merge
+            x = unmerge(self.attn1(merge(self.norm1(x)), context=context if self.disable_self_attn else None, mask=mask)) + x
         x = self.attn2(self.norm2(x), context=context, mask=mask) + x
         x = self.ff(self.norm3(x)) + x
         return x
@@ -232,6 +401,8 @@ class SpatialTransformer(nn.Module):
         else:
             self.proj_out = zero_module(nn.Linear(inner_dim, in_channels))
         self.use_linear = use_linear
+        # fraction of the tokens of each frame merged before self attention, set by UNet3DModel.set_token_merging
+        self.token_merge_ratio = 0.0
 
 
     def forward(self, x, context=None, **kwargs):
@@ -243,6 +414,8 @@ class SpatialTransformer(nn.Module):
         x = rearrange(x, 'b c h w -> b (h w) c').contiguous()
         if self.use_linear:
             x = self.proj_in(x)
+        if self.token_merge_ratio > 0 and not torch.is_grad_enabled():
+            kwargs = dict(kwargs, token_merge=bipartite_soft_matching(x, h, w, self.token_merge_ratio))
         for i, block in enumerate(self.transformer_blocks):
             x = block(x, context=context, **kwargs)
         if self.use_linear:
@@ -316,14 +489,45 @@ class TemporalTransformer(nn.Module):
         if self.use_linear:
             x = self.proj_in(x)
 
+        x = self.transform(x, context, b, t, h, w)
+        
+        if self.use_linear:
+            x = self.proj_out(x)
+            x = rearrange(x, 'b (h w) t c -> b c t h w', h=h, w=w).contiguous()
+        if not self.use_linear:
+            x = rearrange(x, 'b hw t c -> (b hw) c t').contiguous()
+            x = self.proj_out(x)
+            x = rearrange(x, '(b h w) c t -> b c t h w', b=b, h=h, w=w).contiguous()
+
+        return x + x_in
+
+    def forward_folded(self, x, context, batch_size):
+        # Same as forward on the (b c t h w) video, with x and the result stored as (b t) c h w like the spatial
+        # layers: one copy into the (b h w) t c sequences, the 1x1 projections as linears, and the residual add
+        # reading the output back through a permuted view.
+        bt, c, h, w = x.shape
+        b, t = batch_size, bt // batch_size
+        x_in = x
+
+        x = folded_group_norm(self.norm, x, b)
+        x = x.view(b, t, c, h, w).permute(0, 3, 4, 1, 2).reshape(b * h * w, t, c)
+        x = F.linear(x, self.proj_in.weight.flatten(1), self.proj_in.bias)
+
+        x = self.transform(x, context, b, t, h, w)
+
+        x = F.linear(x, self.proj_out.weight.flatten(1), self.proj_out.bias)
+        x = x.view(b, h, w, t, c).permute(0, 3, 4, 1, 2)
+        return (x_in.view(b, t, c, h, w) + x).view(bt, c, h, w)
+
+    def transform(self, x, context, b, t, h, w):
+        # the transformer blocks on the ((b h w), t, c) sequences, returned as (b, h w, t, c)
         temp_mask = None
         if self.causal_attention:
             # slice the from mask map
             temp_mask = self.mask[:,:t,:t].to(x.device)
 
         if temp_mask is not None:
-            mask = temp_mask.to(x.device)
-            mask = repeat(mask, 'l i j -> (l bhw) i j', bhw=b*h*w)
+            mask = temp_mask.expand(b * h * w, -1, -1)
         else:
             mask = None
 
@@ -343,16 +547,7 @@ class TemporalTransformer(nn.Module):
                         't l con -> (t r) l con', r=(h * w) // t, t=t).contiguous()
                     ## note: causal mask will not applied in cross-attention case
                     x[j] = block(x[j], context=context_j)
-        
-        if self.use_linear:
-            x = self.proj_out(x)
-            x = rearrange(x, 'b (h w) t c -> b c t h w', h=h, w=w).contiguous()
-        if not self.use_linear:
-            x = rearrange(x, 'b hw t c -> (b hw) c t').contiguous()
-            x = self.proj_out(x)
-            x = rearrange(x, '(b h w) c t -> b c t h w', b=b, h=h, w=w).contiguous()
-
-        return x + x_in
+        return x
     
 
 class GEGLU(nn.Module):
@@ -0,0 +1,147 @@
+# attention backends for diffusers_vdm: PyTorch SDPA, xformers, naive bmm and a query-chunked version
+# the first call of each (device, dtype, shape class) times every available backend on the real inputs
+# and keeps the fastest one that matches the reference output
+
+import math
+import time
+import torch
+
+from functools import lru_cache, partial
+
+
+attention_chunk_bytes = 512 * 1024 ** 2
+# naive attention is not timed where its weights would exceed this, chunked attention covers those shapes
+naive_max_bytes = 2 * attention_chunk_bytes
+autotune_repeats = 3
+
+forced_backend = None
+selected_backends = {}
+
+
+def sdpa_attention(q, k, v, scale):
+    # the fused flash and memory-efficient kernels need 4-D inputs, 3-D ones fall back to the math kernel
+    return torch.nn.functional.scaled_dot_product_attention(q[None], k[None], v[None], scale=scale)[0]
+
+
+def xformers_attention(q, k, v, scale):
+    import xformers.ops
+    return xformers.ops.memory_efficient_attention(q, k, v, scale=scale)
+
+
+def naive_attention(q, k, v, scale):
+    weight = torch.baddbmm(
+        torch.empty(q.shape[0], q.shape[1], k.shape[1], device=q.device, dtype=q.dtype),
+        q, k.transpose(1, 2), beta=0, alpha=scale
+    )
+    weight = torch.softmax(weight.float(), dim=-1).type(q.dtype)
+    return torch.bmm(weight, v)
+
+
+def chunked_attention(q, k, v, scale):
+    # naive attention over chunks of queries, so the weights never exceed attention_chunk_bytes
+    chunk = max(1, attention_chunk_bytes // (q.shape[0] * k.shape[1] * 4))
+    if chunk >= q.shape[1]:
+        return naive_attention(q, k, v, scale)
+    return torch.cat([naive_attention(q[:, i:i + chunk], k, v, scale) for i in range(0, q.shape[1], chunk)], dim=1)
+
+
+def xformers_available(device):
+    if device.type != 'cuda':
+        return False
+    try:
+        import xformers.ops
+    except ImportError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def available_backends(device):
+    backends = dict(sdpa=sdpa_attention)
+    if xformers_available(device):
+        backends['xformers'] = xformers_attention
+    backends['naive'] = naive_attention
+    backends['chunked'] = chunked_attention
+    return backends
+
+
+def set_attention_backend(name=None):
+    # name=None goes back to autotuning; selections made so far are forgotten
+    global forced_backend
+    forced_backend = name
+    selected_backends.clear()
+    return
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return
+
+
+def autotune(candidates, device, fallback='sdpa'):
+    # candidates: name -> function without arguments; the first result is the reference of the others
+    # fallback: the name returned when no candidate ran
+    reference = None
+    timings = {}
+
+    for name, fn in candidates.items():
+        try:
+            out = fn()
+            if reference is None:
+                reference = out.float()
+            elif not torch.allclose(out.float(), reference, atol=1e-2, rtol=1e-2):
+                continue
+
+            synchronize(device)
+            begin = time.perf_counter()
+            for _ in range(autotune_repeats):
+                fn()
+            synchronize(device)
+            timings[name] = (time.perf_counter() - begin) / autotune_repeats
+        except Exception:
+            # e.g. out of memory or an unsupported shape, reported as failed by select_backend
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+    if len(timings) == 0:
+        return fallback, timings
+    return min(timings, key=timings.get), timings
+
+
+def select_backend(key, candidates, device, fallback='sdpa'):
+    # runs the candidates once per key and remembers the fastest
+    name = selected_backends.get(key, None)
+    if name is None:
+        name, timings = autotune(candidates, device, fallback)
+        print(f'Attention backend for {key}: {name}',
+              {k: f'{timings[k] * 1000:.2f}ms' if k in timings else 'failed' for k in candidates})
+        selected_backends[key] = name
+    return name
+
+
+def attention(q, k, v, shape_class, scale=None):
+    # q, k, v: (batch * heads, length, dim_head); shape_class names the call site, e.g. 'spatial'
+    scale = 1 / math.sqrt(q.shape[-1]) if scale is None else scale
+    backends = available_backends(q.device)
+
+    if forced_backend is not None:
+        return backends[forced_backend](q, k, v, scale)
+
+    if torch.is_grad_enabled():
+        # no timing runs while training: xformers where it is installed, as before, otherwise sdpa
+        return backends.get('xformers', sdpa_attention)(q, k, v, scale)
+
+    key = (str(q.device), q.dtype, shape_class)
+    naive_too_large = q.shape[0] * q.shape[1] * k.shape[1] * 4 > naive_max_bytes
+    if key not in selected_backends:
+        candidates = {name: partial(fn, q, k, v, scale) for name, fn in backends.items()}
+        if naive_too_large:
+            del candidates['naive']
+        select_backend(key, candidates, q.device)
+
+    name = selected_backends[key]
+    if name == 'naive' and naive_too_large:
+        # selected on a smaller shape of the same class
+        name = 'chunked'
+    return backends[name](q, k, v, scale)
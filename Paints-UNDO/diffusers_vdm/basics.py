@@ -132,6 +132,44 @@ def make_temporal_window(x, t, method):
         return recon
 
 
+def folded_group_norm(norm, x, batch_size):
+    # nn.GroupNorm of the (b, c, t, h, w) video, applied to x stored as (b t) c h w without moving the frames.
+    # The statistics are accumulated in float and folded with the affine into one scale and shift per channel.
+    bt, c, h, w = x.shape
+    groups = norm.num_groups
+    y = x.view(batch_size, bt // batch_size, groups, c // groups, h, w)
+    dims = (1, 3, 4, 5)
+    n = y.numel() // (batch_size * groups)
+
+    mean = y.sum(dim=dims, keepdim=True, dtype=torch.float32) / n
+    var = torch.linalg.vector_norm(y, dim=dims, keepdim=True, dtype=torch.float32).square_() / n - mean.square()
+    scale = torch.rsqrt(var.clamp_(min=0) + norm.eps)
+
+    if norm.affine:
+        scale = scale * norm.weight.float().view(1, 1, groups, c // groups, 1, 1)
+        shift = norm.bias.float().view(1, 1, groups, c // groups, 1, 1) - mean * scale
+    else:
+        shift = -mean * scale
+
+    return torch.addcmul(shift.to(x.dtype), y, scale.to(x.dtype)).view(bt, c, h, w)
+
+
+def folded_temporal_conv(conv, x, batch_size):
+    # nn.Conv3d with a (3, 1, 1) kernel and (1, 0, 0) padding over the frames, applied to x stored as (b t) c h w:
+    # one 1x1 convolution for the three taps, then each frame adds the taps of its neighbours
+    bt, c, h, w = x.shape
+    t = bt // batch_size
+    weight = conv.weight[:, :, :, 0, 0].permute(2, 0, 1)[..., None, None].flatten(0, 1)
+    taps = torch.nn.functional.conv2d(x, weight).view(batch_size, t, 3, -1, h, w)
+
+    out = taps[:, :, 1].clone()
+    out[:, 1:] += taps[:, :-1, 0]
+    out[:, :-1] += taps[:, 1:, 2]
+    if conv.bias is not None:
+        out += conv.bias.view(1, 1, -1, 1, 1)
+    return out.view(bt, -1, h, w)
+
+
 def checkpoint(func, inputs, params, flag):
     """
     Evaluate a function without caching intermediate activations, allowing for
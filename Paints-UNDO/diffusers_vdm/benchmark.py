@@ -0,0 +1,420 @@
+# helpers to measure the video sampler, used when tuning the inference path
+
+import time
+import torch
+import warnings
+
+from contextlib import contextmanager
+
+
+class SyncCounter:
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def count_cuda_syncs():
+    # counts host-device synchronizations reported by torch.cuda sync debug mode
+    counter = SyncCounter()
+
+    if not torch.cuda.is_available():
+        yield counter
+        return
+
+    previous_mode = torch.cuda.get_sync_debug_mode()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try:
+            yield counter
+        finally:
+            torch.cuda.set_sync_debug_mode(previous_mode)
+            counter.count = sum('synchronizing' in str(w.message) for w in caught)
+    return
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    return
+
+
+@torch.inference_mode()
+def benchmark_sampler(sampler, latent_shape, steps, extra_args, repeats=1):
+    device = sampler.unet.device
+    seconds = []
+    syncs = []
+
+    for _ in range(repeats):
+        synchronize(device)
+        begin = time.perf_counter()
+        with count_cuda_syncs() as counter:
+            sampler(latent_shape, steps, extra_args=extra_args, progress_tqdm=lambda x: x)
+        synchronize(device)
+        seconds.append(time.perf_counter() - begin)
+        syncs.append(counter.count)
+
+    return dict(
+        steps=steps,
+        seconds=min(seconds),
+        seconds_per_step=min(seconds) / steps,
+        syncs=max(syncs),
+        syncs_per_step=max(syncs) / steps,
+    )
+
+
+def relative_deviation(x, reference):
+    x, reference = x.float(), reference.float()
+    return ((x - reference).abs().mean() / reference.abs().mean().clamp(min=1e-8)).item()
+
+
+@torch.inference_mode()
+def count_unet_flops(unet, x, t, **cond):
+    from torch.utils.flop_counter import FlopCounterMode
+
+    with FlopCounterMode(display=False) as flop_counter:
+        unet(x, t, **cond)
+    return flop_counter.get_total_flops()
+
+
+@torch.inference_mode()
+def compare_guidance_schedules(pipeline, schedules, steps=50, seed=123, **call_kwargs):
+    # `schedules` maps a mode name to a GuidanceSchedule; the reference is plain CFG at every step
+    sampler = pipeline.get_sampler()
+
+    torch.manual_seed(seed)
+    reference = pipeline(steps=steps, guidance_schedule=None, progress_tqdm=lambda x: x, **call_kwargs)
+    reference_passes = sampler.unet_passes
+
+    concat_cond = call_kwargs['concat_cond'].to(device=pipeline.unet.device, dtype=pipeline.unet.dtype)
+    fs = torch.tensor([call_kwargs.get('fs', 3)] * concat_cond.shape[0], dtype=torch.long, device=concat_cond.device)
+    flops_per_pass = count_unet_flops(
+        pipeline.unet, torch.zeros_like(concat_cond), torch.full_like(fs, 999),
+        context_text=call_kwargs['positive_text_cond'].to(concat_cond),
+        context_img=call_kwargs['positive_image_cond'].to(concat_cond),
+        concat_cond=concat_cond, fs=fs
+    )
+
+    results = {}
+    for name, schedule in schedules.items():
+        torch.manual_seed(seed)
+        begin = time.perf_counter()
+        latents = pipeline(steps=steps, guidance_schedule=schedule, progress_tqdm=lambda x: x, **call_kwargs)
+        synchronize(pipeline.unet.device)
+        passes = sampler.unet_passes
+        results[name] = dict(
+            seconds=time.perf_counter() - begin,
+            unet_passes=passes,
+            passes_saved=reference_passes - passes,
+            flops_saved=(reference_passes - passes) * flops_per_pass,
+            flops_saved_fraction=(reference_passes - passes) / reference_passes,
+            deviation=relative_deviation(latents, reference),
+        )
+    return results
+
+
+@torch.inference_mode()
+def compare_solvers(pipeline, solvers=('dpmpp_2m', 'dpmpp_3m', 'unipc'), steps_list=(10, 15, 20, 25, 30),
+                    eta=0.0, reference_steps=50, seed=123, **call_kwargs):
+    # quality vs steps of the multistep solvers against the 50-step DDIM baseline with the same seed and eta,
+    # so the deviation measures solver convergence and not a different noise path
+    torch.manual_seed(seed)
+    begin = time.perf_counter()
+    reference = pipeline(steps=reference_steps, solver='ddim', eta=eta, progress_tqdm=lambda x: x, **call_kwargs)
+    synchronize(pipeline.unet.device)
+    results = dict(reference=dict(steps=reference_steps, seconds=time.perf_counter() - begin))
+
+    for solver in solvers:
+        for steps in steps_list:
+            torch.manual_seed(seed)
+            begin = time.perf_counter()
+            latents = pipeline(steps=steps, solver=solver, eta=eta, progress_tqdm=lambda x: x, **call_kwargs)
+            synchronize(pipeline.unet.device)
+            results[f'{solver}_{steps}'] = dict(
+                steps=steps,
+                seconds=time.perf_counter() - begin,
+                deviation=relative_deviation(latents, reference),
+            )
+    return results
+
+
+@torch.inference_mode()
+def compare_coarse_to_fine(pipeline, fractions=(0.2, 0.3, 0.4, 0.5), coarse_scale=0.5, steps=50, seed=123,
+                           **call_kwargs):
+    # wall time and deviation of coarse-to-fine sampling against full resolution sampling with the same seed
+    torch.manual_seed(seed)
+    synchronize(pipeline.unet.device)
+    begin = time.perf_counter()
+    reference = pipeline(steps=steps, progress_tqdm=lambda x: x, **call_kwargs)
+    synchronize(pipeline.unet.device)
+    reference_seconds = time.perf_counter() - begin
+    results = dict(reference=dict(seconds=reference_seconds))
+
+    for fraction in fractions:
+        torch.manual_seed(seed)
+        begin = time.perf_counter()
+        latents = pipeline(steps=steps, coarse_fraction=fraction, coarse_scale=coarse_scale,
+                           progress_tqdm=lambda x: x, **call_kwargs)
+        synchronize(pipeline.unet.device)
+        seconds = time.perf_counter() - begin
+        results[f'coarse_{fraction}'] = dict(
+            seconds=seconds,
+            speedup=reference_seconds / seconds,
+            deviation=relative_deviation(latents, reference),
+        )
+    return results
+
+
+@torch.inference_mode()
+def compare_prepared_conditions(pipeline, steps=50, seed=123, repeats=1, **prepare_kwargs):
+    # per-step time of the sampler with and without the step-invariant UNet conditions built once per run,
+    # each step being one batched pass of both cfg branches; prepare_kwargs as for prepare_sampler_kwargs
+    sampler = pipeline.get_sampler()
+    latent_shape, sampler_kwargs = pipeline.prepare_sampler_kwargs(**prepare_kwargs)
+    device = pipeline.unet.device
+
+    results = {}
+    for prepare_conditions in [False, True]:
+        seconds = []
+        for _ in range(repeats):
+            torch.manual_seed(seed)
+            synchronize(device)
+            begin = time.perf_counter()
+            latents = sampler(latent_shape, steps, extra_args=sampler_kwargs, progress_tqdm=lambda x: x,
+                              prepare_conditions=prepare_conditions)
+            synchronize(device)
+            seconds.append(time.perf_counter() - begin)
+        results['prepared' if prepare_conditions else 'per_step'] = dict(
+            seconds=min(seconds), seconds_per_step=min(seconds) / steps, latents=latents
+        )
+
+    reference = results['per_step'].pop('latents')
+    prepared = results['prepared'].pop('latents')
+    results['seconds_saved_per_step'] = results['per_step']['seconds_per_step'] - results['prepared']['seconds_per_step']
+    results['deviation'] = relative_deviation(prepared, reference)
+    return results
+
+
+@torch.inference_mode()
+def compare_cross_attention_kv_cache(pipeline, steps=50, seed=123, **call_kwargs):
+    # per-step time with and without the cross attention K/V cache, and the memory the cache held
+    sampler = pipeline.get_sampler()
+    results = {}
+
+    for enabled in [False, True]:
+        torch.manual_seed(seed)
+        synchronize(pipeline.unet.device)
+        begin = time.perf_counter()
+        latents = pipeline(steps=steps, progress_tqdm=lambda x: x, cross_attention_kv_cache=enabled, **call_kwargs)
+        synchronize(pipeline.unet.device)
+        seconds = time.perf_counter() - begin
+        results['cached' if enabled else 'uncached'] = dict(seconds=seconds, seconds_per_step=seconds / steps)
+        if enabled:
+            results['cached'].update(sampler.last_kv_cache_stats)
+            results['deviation'] = relative_deviation(latents, reference)
+        else:
+            reference = latents
+
+    results['speedup'] = results['uncached']['seconds'] / results['cached']['seconds']
+    return results
+
+
+@torch.inference_mode()
+def compare_temporal_attention(buckets=((320, 512), (384, 448)), levels=((1, 320), (2, 640), (4, 1280), (8, 1280)),
+                               batch_size=2, frames=16, dim_head=64, repeats=10, device='cuda', dtype=torch.float16):
+    # the short-sequence temporal attention against the general sdp path, on the (b h w, t, c) inputs of
+    # every UNet level: latent size is bucket / 8 / downscale, batch 2 for the two cfg branches
+    from diffusers_vdm.attention import sdp, short_sequence_attention
+
+    device = torch.device(device)
+    results = {}
+
+    for height, width in buckets:
+        for downscale, channels in levels:
+            h, w = height // 8 // downscale, width // 8 // downscale
+            heads = channels // dim_head
+            q, k, v = (torch.randn(batch_size * h * w, frames, channels, device=device, dtype=dtype) for _ in range(3))
+
+            seconds = {}
+            for name, fn in [('sdp', lambda: sdp(q, k, v, heads, shape_class='temporal')),
+                             ('short_sequence', lambda: short_sequence_attention(q, k, v, heads))]:
+                out = fn()
+                synchronize(device)
+                begin = time.perf_counter()
+                for _ in range(repeats):
+                    fn()
+                synchronize(device)
+                seconds[name] = (time.perf_counter() - begin) / repeats
+                if name == 'sdp':
+                    reference = out
+
+            results[f'{height}x{width}/{downscale}'] = dict(
+                sequences=batch_size * h * w,
+                sdp_ms=seconds['sdp'] * 1000,
+                short_sequence_ms=seconds['short_sequence'] * 1000,
+                speedup=seconds['sdp'] / seconds['short_sequence'],
+                deviation=relative_deviation(out, reference),
+            )
+    return results
+
+
+@torch.inference_mode()
+def compare_window_attention(buckets=((320, 512), (384, 448)), levels=((1, 320), (2, 640), (4, 1280), (8, 1280)),
+                             batch_size=2, frames=16, dim_head=64, repeats=10, device='cuda', dtype=torch.float16):
+    # spatial self attention with the 'prv' temporal window: the concatenated K/V windows against the merged
+    # previous-frame path, time and peak memory on the (b t, h w, c) inputs of every UNet level
+    from diffusers_vdm.attention import sdp, previous_frame_window_attention
+    from diffusers_vdm.basics import make_temporal_window
+
+    device = torch.device(device)
+    results = {}
+
+    for height, width in buckets:
+        for downscale, channels in levels:
+            h, w = height // 8 // downscale, width // 8 // downscale
+            heads = channels // dim_head
+            q, k, v = (torch.randn(batch_size * frames, h * w, channels, device=device, dtype=dtype) for _ in range(3))
+
+            def concat():
+                return sdp(q, make_temporal_window(k, t=frames, method='prv'),
+                           make_temporal_window(v, t=frames, method='prv'), heads)
+
+            seconds, peak_bytes, outputs = {}, {}, {}
+            for name, fn in [('concat', concat),
+                             ('merged', lambda: previous_frame_window_attention(q, k, v, heads, frames))]:
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats(device)
+                base_bytes = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+                outputs[name] = fn()
+                synchronize(device)
+                peak_bytes[name] = torch.cuda.max_memory_allocated(device) - base_bytes if device.type == 'cuda' else 0
+                begin = time.perf_counter()
+                for _ in range(repeats):
+                    fn()
+                synchronize(device)
+                seconds[name] = (time.perf_counter() - begin) / repeats
+
+            results[f'{height}x{width}/{downscale}'] = dict(
+                tokens=h * w,
+                concat_ms=seconds['concat'] * 1000,
+                merged_ms=seconds['merged'] * 1000,
+                speedup=seconds['concat'] / seconds['merged'],
+                concat_peak_mb=peak_bytes['concat'] / 1024 ** 2,
+                merged_peak_mb=peak_bytes['merged'] / 1024 ** 2,
+                deviation=relative_deviation(outputs['merged'], outputs['concat']),
+            )
+            del outputs
+    return results
+
+
+@torch.inference_mode()
+def compare_inference_layout(pipeline, steps=50, seed=123, **prepare_kwargs):
+    # per-step time, bytes allocated and peak memory of the sampler with and without the UNet inference layout;
+    # prepare_kwargs as for prepare_sampler_kwargs
+    sampler = pipeline.get_sampler()
+    latent_shape, sampler_kwargs = pipeline.prepare_sampler_kwargs(**prepare_kwargs)
+    unet = pipeline.unet
+    device = unet.device
+
+    results = {}
+    for enabled in [False, True]:
+        unet.enable_inference_layout(enabled)
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+            allocated = torch.cuda.memory_stats(device).get('allocated_bytes.all.allocated', 0)
+
+        torch.manual_seed(seed)
+        synchronize(device)
+        begin = time.perf_counter()
+        latents = sampler(latent_shape, steps, extra_args=sampler_kwargs, progress_tqdm=lambda x: x)
+        synchronize(device)
+        seconds = time.perf_counter() - begin
+
+        result = dict(seconds=seconds, seconds_per_step=seconds / steps, latents=latents)
+        if device.type == 'cuda':
+            allocated = torch.cuda.memory_stats(device).get('allocated_bytes.all.allocated', 0) - allocated
+            result.update(allocated_bytes_per_step=allocated / steps,
+                          peak_bytes=torch.cuda.max_memory_allocated(device),
+                          skip_buffer_bytes=sum(b.numel() * b.element_size() for b in unet.skip_buffers.values()))
+        results['inference_layout' if enabled else 'default'] = result
+
+    unet.enable_inference_layout(False)
+    reference = results['default'].pop('latents')
+    results['deviation'] = relative_deviation(results['inference_layout'].pop('latents'), reference)
+    results['speedup'] = results['default']['seconds'] / results['inference_layout']['seconds']
+    return results
+
+
+@torch.inference_mode()
+def compare_deep_cache(pipeline, schedules=((2, 1), (3, 1), (3, 2), (5, 1)), steps=50, seed=123, full_steps=(),
+                       hidden_states=None, **call_kwargs):
+    # drift of DeepFeatureCache schedules against full computation: each (interval, branch) runs from the same
+    # seed, and the final latents are compared overall and per frame; with the hidden states of the input
+    # frames the latents are also decoded and compared as pixels (psnr on [-1, 1] pixels)
+    from diffusers_vdm.unet import DeepFeatureCache
+
+    sampler = pipeline.get_sampler()
+    device = pipeline.unet.device
+
+    def run(deep_cache):
+        torch.manual_seed(seed)
+        synchronize(device)
+        begin = time.perf_counter()
+        latents = pipeline(steps=steps, progress_tqdm=lambda x: x, deep_cache=deep_cache, **call_kwargs)
+        synchronize(device)
+        return latents, time.perf_counter() - begin
+
+    reference, reference_seconds = run(None)
+    reference_pixels = None if hidden_states is None else pipeline.decode_latents(reference, hidden_states).float()
+    results = dict(full=dict(seconds=reference_seconds, seconds_per_step=reference_seconds / steps))
+
+    for interval, branch in schedules:
+        latents, seconds = run(DeepFeatureCache(interval=interval, branch=branch, full_steps=full_steps))
+        result = dict(seconds=seconds, seconds_per_step=seconds / steps, speedup=reference_seconds / seconds,
+                      deviation=relative_deviation(latents, reference),
+                      max_frame_deviation=max(relative_deviation(latents[:, :, i], reference[:, :, i])
+                                              for i in range(latents.shape[2])))
+        result.update(sampler.last_deep_cache_stats)
+
+        if reference_pixels is not None:
+            pixels = pipeline.decode_latents(latents, hidden_states).float()
+            mse = (pixels - reference_pixels).square().mean().clamp(min=1e-10)
+            result['psnr'] = (10 * torch.log10(4 / mse)).item()
+
+        results[f'interval_{interval}_branch_{branch}'] = result
+    return results
+
+
+@torch.inference_mode()
+def compare_token_merging(pipeline, ratio_sets=({1: 0.3}, {1: 0.5}, {1: 0.5, 2: 0.25}), steps=50, seed=123,
+                          **call_kwargs):
+    # time and drift of token merging against full spatial self attention, for each {downsample rate: ratio};
+    # the resolution bucket is the one of the conditions in call_kwargs, so run once per bucket
+    unet = pipeline.unet
+    device = unet.device
+
+    def run(ratios):
+        unet.set_token_merging(ratios)
+        torch.manual_seed(seed)
+        synchronize(device)
+        begin = time.perf_counter()
+        latents = pipeline(steps=steps, progress_tqdm=lambda x: x, **call_kwargs)
+        synchronize(device)
+        return latents, time.perf_counter() - begin
+
+    try:
+        reference, reference_seconds = run(None)
+        results = dict(full=dict(seconds=reference_seconds, seconds_per_step=reference_seconds / steps))
+
+        for ratios in ratio_sets:
+            latents, seconds = run(ratios)
+            results[', '.join(f'{ds}: {ratio}' for ds, ratio in ratios.items())] = dict(
+                seconds=seconds, seconds_per_step=seconds / steps, speedup=reference_seconds / seconds,
+                deviation=relative_deviation(latents, reference),
+            )
+    finally:
+        unet.set_token_merging(None)
+    return results
@@ -0,0 +1,123 @@
+# cache of CLIP vision and Resampler conditioning for the video pipeline
+# CLIP vision runs per frame, so it is keyed by frame digest and resolution; the Resampler mixes all input
+# frames of a segment, so its output is keyed by the digests of the whole frame sequence
+
+import hashlib
+import weakref
+import threading
+import torch
+import einops
+
+from collections import OrderedDict
+
+
+def frame_digest(frame):
+    # c, h, w
+    frame = frame.detach().to('cpu').contiguous()
+    digest = hashlib.blake2b(frame.view(torch.uint8).numpy().tobytes(), digest_size=16).hexdigest()
+    return digest, tuple(frame.shape), str(frame.dtype)
+
+
+class ImageConditionCache:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, models, key):
+        k = (tuple(id(m) for m in models), key)
+        with self.lock:
+            entry = self.entries.get(k, None)
+            if entry is None:
+                return None
+            refs, value = entry
+            if any(r() is not m for r, m in zip(refs, models)):
+                # the models at these addresses were replaced
+                del self.entries[k]
+                return None
+            self.entries.move_to_end(k)
+            return value
+
+    def put(self, models, key, value):
+        k = (tuple(id(m) for m in models), key)
+        with self.lock:
+            self.entries[k] = (tuple(weakref.ref(m) for m in models), value)
+            self.entries.move_to_end(k)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return
+
+    def frame_keys(self, frames):
+        # b, c, t, h, w -> one key per (sample, frame)
+        return [tuple(frame_digest(frames[i, :, j]) for j in range(frames.shape[2])) for i in range(frames.shape[0])]
+
+    def negative_key(self, frames):
+        return 'negative', tuple(frames.shape[1:])
+
+    def missing(self, pipeline, frames):
+        models = (pipeline.image_encoder, pipeline.image_projection)
+        return [k for k in self.frame_keys(frames) + [self.negative_key(frames)] if self.get(models, k) is None]
+
+    @torch.inference_mode()
+    def encode_clip_vision(self, pipeline, frames, frame_keys):
+        # only the frames that are not cached go through CLIP vision, in one batch
+        models = (pipeline.image_encoder, )
+
+        flat_frames, flat_keys = [], []
+        for i, keys in enumerate(frame_keys):
+            for j, k in enumerate(keys):
+                if self.get(models, k) is None and k not in flat_keys:
+                    flat_frames.append(frames[i, :, j])
+                    flat_keys.append(k)
+
+        if len(flat_frames) > 0:
+            self.misses += len(flat_frames)
+            x = torch.stack(flat_frames, dim=1)[None].to(device=pipeline.image_encoder.device,
+                                                         dtype=pipeline.image_encoder.dtype)
+            embeds = pipeline.encode_clip_vision(x)[0]
+            for k, embed in zip(flat_keys, embeds):
+                self.put(models, k, embed)
+
+        self.hits += sum(len(keys) for keys in frame_keys) - len(flat_frames)
+
+        return torch.stack([torch.stack([self.get(models, k) for k in keys], dim=0) for keys in frame_keys], dim=0)
+
+    @torch.inference_mode()
+    def encode_image_cond(self, pipeline, frames):
+        # frames: b, c, t, h, w in [-1, 1]; returns the positive and negative image cond of the pipeline
+        models = (pipeline.image_encoder, pipeline.image_projection)
+        frame_keys = self.frame_keys(frames)
+
+        results = []
+        for i, keys in enumerate(frame_keys):
+            positive = self.get(models, keys)
+            if positive is None:
+                clipvision_embed = self.encode_clip_vision(pipeline, frames[i:i + 1], [keys])
+                positive = pipeline.image_projection(clipvision_embed.to(pipeline.image_projection.dtype))
+                self.put(models, keys, positive)
+            results.append(positive)
+
+        positive_image_cond = torch.cat(results, dim=0)
+
+        negative_key = self.negative_key(frames)
+        negative_image_cond = self.get(models, negative_key)
+        if negative_image_cond is None:
+            # depends only on the resolution, so computed once per bucket
+            zeros = torch.zeros_like(frames[:1]).to(device=pipeline.image_encoder.device,
+                                                    dtype=pipeline.image_encoder.dtype)
+            negative_image_cond = pipeline.image_projection(pipeline.encode_clip_vision(zeros))
+            self.put(models, negative_key, negative_image_cond)
+
+        negative_image_cond = einops.repeat(negative_image_cond, '1 ... -> b ...', b=frames.shape[0])
+        return positive_image_cond, negative_image_cond
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self.entries))
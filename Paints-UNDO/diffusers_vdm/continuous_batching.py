@@ -0,0 +1,167 @@
+# step-level continuous batching for the video sampler:
+# jobs at different denoising steps share one UNet pass (the UNet takes one timestep per sample),
+# and waiting jobs are admitted as soon as running ones finish
+
+import itertools
+import threading
+import torch
+
+from collections import deque
+from diffusers_vdm.dynamic_tsnr_sampler import get_dynamic_tsnr_step_coefficients, rescale_noise_cfg
+
+
+class DenoisingJob:
+    def __init__(self, latent_shape, steps, extra_args, seed=0, eta=1.0, job_id=None):
+        # extra_args as built by LatentVideoDiffusionPipeline.prepare_sampler_kwargs
+        self.latent_shape = tuple(latent_shape)
+        self.steps = int(steps)
+        self.extra_args = extra_args
+        self.seed = seed
+        self.eta = eta
+        self.job_id = job_id
+
+        self.x = None
+        self.generator = None
+        self.coefficients = None
+        self.step_index = 0
+        self.result = None
+
+    @property
+    def batch_size(self):
+        return self.latent_shape[0]
+
+    @property
+    def done(self):
+        return self.result is not None
+
+
+class ContinuousBatchingScheduler:
+    def __init__(self, sampler, max_batch_size=4):
+        # max_batch_size counts latent samples per branch; each UNet pass runs both CFG branches
+        self.sampler = sampler
+        self.unet = sampler.unet
+        self.max_batch_size = max_batch_size
+
+        self.waiting = deque()
+        self.running = []
+        self.finished = {}
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count()
+
+    def submit(self, job):
+        with self.lock:
+            if job.job_id is None:
+                job.job_id = next(self.job_ids)
+            self.waiting.append(job)
+        return job.job_id
+
+    def start(self, job):
+        device, dtype = self.unet.device, self.unet.dtype
+        job.generator = torch.Generator(device=device).manual_seed(int(job.seed))
+        job.x = torch.randn(job.latent_shape, generator=job.generator, device=device, dtype=dtype)
+        job.coefficients = get_dynamic_tsnr_step_coefficients(
+            job.steps, self.sampler.terminal_scale, job.eta, self.sampler.n_timestep
+        )
+        job.step_index = 0
+        return
+
+    def admit(self):
+        with self.lock:
+            while self.waiting:
+                running_size = sum(job.batch_size for job in self.running)
+                if self.running and running_size + self.waiting[0].batch_size > self.max_batch_size:
+                    break
+                job = self.waiting.popleft()
+                self.start(job)
+                self.running.append(job)
+        return
+
+    def pack(self):
+        # the oldest running job and every other one with the same latent shape that still fits
+        shape = self.running[0].latent_shape[1:]
+        batch, size = [], 0
+        for job in self.running:
+            if job.latent_shape[1:] != shape:
+                continue
+            if batch and size + job.batch_size > self.max_batch_size:
+                continue
+            batch.append(job)
+            size += job.batch_size
+        return batch
+
+    @staticmethod
+    def stack_conditions(batch):
+        # [positive of every job, negative of every job], matching torch.cat([x, x])
+        conditions = {}
+        for k, v in batch[0].extra_args['positive'].items():
+            values = [job.extra_args[branch][k] for branch in ['positive', 'negative'] for job in batch]
+            if isinstance(v, torch.Tensor):
+                conditions[k] = torch.cat(values, dim=0)
+            else:
+                assert all(value == v for value in values), f'Cannot batch different non-tensor conditions for {k}.'
+                conditions[k] = v
+        return conditions
+
+    @torch.no_grad()
+    def step(self):
+        self.admit()
+
+        if not self.running:
+            return 0
+
+        batch = self.pack()
+
+        x = torch.cat([job.x for job in batch], dim=0)
+        t = torch.cat([
+            torch.full((job.batch_size,), job.coefficients[job.step_index][0], device=x.device, dtype=x.dtype)
+            for job in batch
+        ], dim=0)
+
+        try:
+            model_output = self.unet(torch.cat([x, x], dim=0), torch.cat([t, t], dim=0), **self.stack_conditions(batch))
+        except torch.cuda.OutOfMemoryError:
+            if len(batch) == 1:
+                raise
+            torch.cuda.empty_cache()
+            self.max_batch_size = max(1, x.shape[0] // 2)
+            print('Continuous batching is out of memory, max_batch_size reduced to', self.max_batch_size)
+            return 0
+
+        p_all, n_all = model_output.chunk(2, dim=0)
+        self.batch_sizes.append(x.shape[0])
+
+        offset = 0
+        for job in batch:
+            p = p_all[offset:offset + job.batch_size]
+            n = n_all[offset:offset + job.batch_size]
+            offset += job.batch_size
+
+            o = n + job.extra_args['cfg_scale'] * (p - n)
+            o = rescale_noise_cfg(o, p, guidance_rescale=self.sampler.guidance_rescale)
+
+            t_, sqrt_alpha, sqrt_one_minus_alpha, c_x0, c_dir, c_noise = job.coefficients[job.step_index]
+            pred_x0, e_t = self.sampler.split_model_output(job.x, o, sqrt_alpha, sqrt_one_minus_alpha)
+            job.x = self.sampler.ddim_update(job.x, pred_x0, e_t, c_x0, c_dir, c_noise, generator=job.generator)
+            job.step_index += 1
+
+            if job.step_index == len(job.coefficients):
+                job.result = job.x
+                self.running.remove(job)
+                self.finished[job.job_id] = job
+
+        return x.shape[0]
+
+    def run_until_idle(self):
+        while self.running or self.waiting:
+            self.step()
+        return self.finished
+
+    def stats(self):
+        iterations = len(self.batch_sizes)
+        mean_batch_size = sum(self.batch_sizes) / max(iterations, 1)
+        return dict(
+            iterations=iterations,
+            mean_batch_size=mean_batch_size,
+            utilization=mean_batch_size / self.max_batch_size,
+        )
@@ -2,12 +2,14 @@
 # dynamic scaling + tsnr + beta modifier + dynamic cfg rescale + ...
 # written by lvmin at stanford 2024
 
+import math
 import torch
 import numpy as np
 
 from tqdm import tqdm
-from functools import partial
+from functools import partial, lru_cache
 from diffusers_vdm.basics import extract_into_tensor
+from diffusers_vdm.attention import CrossAttentionKVCache, set_cross_attention_kv_cache
 
 
 to_torch = partial(torch.tensor, dtype=torch.float32)
@@ -38,6 +40,227 @@ def rescale_zero_terminal_snr(betas):
     return betas
 
 
+@lru_cache(maxsize=16)
+def get_dynamic_tsnr_schedule(n_timestep=1000, terminal_scale=0.7, turning_step=400):
+    linear_start = 0.00085
+    linear_end = 0.012
+
+    betas = np.linspace(linear_start ** 0.5, linear_end ** 0.5, n_timestep, dtype=np.float64) ** 2
+    betas = rescale_zero_terminal_snr(betas)
+    alphas = 1. - betas
+
+    alphas_cumprod = np.cumprod(alphas, axis=0)
+
+    # Dynamic TSNR
+    scale_arr = np.concatenate([
+        np.linspace(1.0, terminal_scale, turning_step),
+        np.full(n_timestep - turning_step, terminal_scale)
+    ])
+
+    alphas_cumprod.setflags(write=False)
+    scale_arr.setflags(write=False)
+    return alphas_cumprod, scale_arr
+
+
+def get_uniform_trailing_timesteps(steps, n_timestep=1000):
+    c = n_timestep / steps
+    ddim_timesteps = np.flip(np.round(np.arange(n_timestep, 0, -c))).astype(np.int64)
+    return ddim_timesteps - 1
+
+
+@lru_cache(maxsize=64)
+def get_dynamic_tsnr_step_coefficients(steps, terminal_scale=0.7, eta=1.0, n_timestep=1000):
+    # Per-step coefficients of the sampling loop, in loop order, as host floats:
+    # (t, sqrt_alpha, sqrt_one_minus_alpha, x0, dir, noise), where the update is
+    # x = x0 * pred_x0 + dir * e_t + noise * randn, with the dynamic x0 rescale folded into x0.
+
+    alphas_cumprod, scale_arr = get_dynamic_tsnr_schedule(n_timestep, terminal_scale)
+
+    # same float32 precision as the registered buffers
+    alphas_cumprod = alphas_cumprod.astype(np.float32).astype(np.float64)
+    scale_arr = scale_arr.astype(np.float32).astype(np.float64)
+
+    timesteps = get_uniform_trailing_timesteps(steps, n_timestep)
+    timesteps_prev = np.concatenate([[0], timesteps[:-1]])
+
+    alphas = alphas_cumprod[timesteps]
+    alphas_prev = alphas_cumprod[timesteps_prev]
+    sigmas = eta * np.sqrt((1 - alphas_prev) / (1 - alphas) * (1 - alphas / alphas_prev))
+    rescale = scale_arr[timesteps_prev] / scale_arr[timesteps]
+
+    coefficients = []
+    for index in reversed(range(len(timesteps))):
+        coefficients.append((
+            int(timesteps[index]),
+            float(np.sqrt(alphas[index])),
+            float(np.sqrt(1. - alphas[index])),
+            float(np.sqrt(alphas_prev[index]) * rescale[index]),
+            float(np.sqrt(max(1. - alphas_prev[index] - sigmas[index] ** 2, 0.))),
+            float(sigmas[index]),
+        ))
+
+    return tuple(coefficients)
+
+
+@lru_cache(maxsize=64)
+def get_dynamic_tsnr_solver_nodes(steps, terminal_scale=0.7, n_timestep=1000):
+    # Nodes of the multistep solvers, in loop order: (t, alpha, sigma, lambda, rescale), with
+    # alpha = sqrt(alphas_cumprod), sigma = sqrt(1 - alphas_cumprod), lambda = log(alpha / sigma),
+    # and rescale the dynamic x0 rescale from this node to the next one. The last node is the
+    # target of the final step (t = 0). With zero terminal SNR the first lambda is -inf.
+
+    alphas_cumprod, scale_arr = get_dynamic_tsnr_schedule(n_timestep, terminal_scale)
+    alphas_cumprod = alphas_cumprod.astype(np.float32).astype(np.float64)
+    scale_arr = scale_arr.astype(np.float32).astype(np.float64)
+
+    timesteps = [int(t) for t in get_uniform_trailing_timesteps(steps, n_timestep)[::-1]] + [0]
+
+    nodes = []
+    for i, t in enumerate(timesteps):
+        alpha = math.sqrt(alphas_cumprod[t])
+        sigma = math.sqrt(1. - alphas_cumprod[t])
+        log_snr = math.log(alpha) - math.log(sigma) if alpha > 0 else -math.inf
+        rescale = scale_arr[timesteps[i + 1]] / scale_arr[t] if i + 1 < len(timesteps) else 1.
+        nodes.append((t, alpha, sigma, log_snr, float(rescale)))
+
+    return tuple(nodes)
+
+
+def dpm_solver_pp_weights(node, node_next, history, eta=0., order=2, midpoint=True):
+    # DPM-Solver++ (2M midpoint / 3M) step in data prediction, optionally with SDE noise (eta > 0),
+    # following the samplers of k-diffusion moved from sigma space to the VP form.
+    # `history` holds the lambdas of previous data predictions, newest first.
+    # Returns (c_x, weights over [denoised, *history], c_noise).
+
+    _, _, sigma, log_snr, _ = node
+    _, alpha_next, sigma_next, log_snr_next, _ = node_next
+
+    h = log_snr_next - log_snr
+    eta_h = eta * h if eta > 0 else 0.
+    h_eta = h + eta_h
+
+    c_x = sigma_next / sigma * math.exp(-eta_h)
+    c_noise = sigma_next * math.sqrt(-math.expm1(-2. * eta_h)) if eta > 0 else 0.
+    d0 = np.zeros(3)
+    d0[0] = 1.
+    weights = -math.expm1(-h_eta) * d0
+
+    order = min(order, len(history) + 1)
+
+    if order == 2:
+        r = (log_snr - history[0]) / h
+        if midpoint:
+            weights += 0.5 * -math.expm1(-h_eta) / r * np.array([1., -1., 0.])
+        else:
+            phi_2 = math.expm1(-h_eta) / h_eta + 1
+            weights += phi_2 / r * np.array([1., -1., 0.])
+    elif order == 3:
+        r0 = (log_snr - history[0]) / h
+        r1 = (history[0] - history[1]) / h
+        d1_0 = np.array([1., -1., 0.]) / r0
+        d1_1 = np.array([0., 1., -1.]) / r1
+        d1 = d1_0 + (d1_0 - d1_1) * r0 / (r0 + r1)
+        d2 = (d1_0 - d1_1) / (r0 + r1)
+        phi_2 = math.expm1(-h_eta) / h_eta + 1
+        phi_3 = phi_2 / h_eta - 0.5
+        weights += phi_2 * d1 - phi_3 * d2
+
+    return c_x, (alpha_next * weights)[:order].tolist(), c_noise
+
+
+def unipc_bh2_weights(node, node_next, history, order=2, corrector=False):
+    # UniPC (B(h) = expm1(-h)) in data prediction, following Zhao et al. 2023 and the diffusers scheduler.
+    # Predictor: weights over [denoised, *history]. Corrector: weights over
+    # [denoised, *history, denoised_next], applied to the sample the predictor started from.
+    # Returns (c_x, weights).
+
+    _, _, sigma, log_snr, _ = node
+    _, alpha_next, sigma_next, log_snr_next, _ = node_next
+
+    h = log_snr_next - log_snr
+    hh = -h
+    h_phi_1 = math.expm1(hh)
+    b_h = math.expm1(hh)
+
+    order = min(order, len(history) + 1)
+    rks = [(l - log_snr) / h for l in history[:order - 1]] + [1.]
+
+    h_phi_k = h_phi_1 / hh - 1
+    factorial_i = 1
+    r_mat, b_vec = [], []
+    for i in range(1, order + 1):
+        r_mat.append([rk ** (i - 1) for rk in rks])
+        b_vec.append(h_phi_k * factorial_i / b_h)
+        factorial_i *= i + 1
+        h_phi_k = h_phi_k / hh - 1 / factorial_i
+    r_mat, b_vec = np.array(r_mat), np.array(b_vec)
+
+    if not corrector:
+        if order == 1:
+            rhos = np.zeros(0)
+        elif order == 2:
+            rhos = np.array([0.5])
+        else:
+            rhos = np.linalg.solve(r_mat[:-1, :-1], b_vec[:-1])
+    else:
+        rhos = np.array([0.5]) if order == 1 else np.linalg.solve(r_mat, b_vec)
+
+    # x_next = sigma_next / sigma * x - alpha_next * h_phi_1 * m0 - alpha_next * b_h * sum(rho_k * D1_k),
+    # with D1_k = (m_k - m0) / r_k for the history and D1_t = m_next - m0 for the corrector
+    weights = np.zeros(order + int(corrector))
+    weights[0] = -h_phi_1
+    for k in range(order - 1):
+        weights[k + 1] -= b_h * rhos[k] / rks[k]
+        weights[0] += b_h * rhos[k] / rks[k]
+    if corrector:
+        weights[-1] -= b_h * rhos[-1]
+        weights[0] += b_h * rhos[-1]
+
+    return sigma_next / sigma, (alpha_next * weights).tolist()
+
+
+def get_temporal_windows(frames, window=16, overlap=4):
+    # (start, end) of overlapping windows covering all frames, the last one aligned to the end
+    if frames <= window:
+        return [(0, frames)]
+    stride = max(window - overlap, 1)
+    starts = list(range(0, frames - window, stride)) + [frames - window]
+    return [(start, start + window) for start in starts]
+
+
+def get_temporal_window_weights(windows):
+    # per-frame blending weights of each window: linear ramps across the overlaps, 1 elsewhere
+    weights = []
+    for i, (start, end) in enumerate(windows):
+        w = np.ones(end - start, dtype=np.float32)
+        if i > 0:
+            overlap = windows[i - 1][1] - start
+            w[:overlap] = np.minimum(w[:overlap], np.arange(1, overlap + 1) / (overlap + 1))
+        if i + 1 < len(windows):
+            overlap = end - windows[i + 1][0]
+            w[-overlap:] = np.minimum(w[-overlap:], np.arange(overlap, 0, -1) / (overlap + 1))
+        weights.append(w)
+    return weights
+
+
+def resize_latents(x, height, width):
+    # b, c, t, h, w; area when shrinking, bilinear per frame when growing
+    if tuple(x.shape[-2:]) == (height, width):
+        return x
+    mode = 'area' if height <= x.shape[-2] and width <= x.shape[-1] else 'trilinear'
+    align_corners = None if mode == 'area' else False
+    return torch.nn.functional.interpolate(x, size=(x.shape[2], height, width), mode=mode,
+                                           align_corners=align_corners)
+
+
+def randn_per_sample(x, generators):
+    # noise like x with sample i drawn from generators[i], independent of the other samples in the batch
+    return torch.cat([
+        torch.randn((1, ) + tuple(x.shape[1:]), generator=generator, device=x.device, dtype=x.dtype)
+        for generator in generators
+    ], dim=0)
+
+
 def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=0.0):
     std_text = noise_pred_text.std(dim=list(range(1, noise_pred_text.ndim)), keepdim=True)
     std_cfg = noise_cfg.std(dim=list(range(1, noise_cfg.ndim)), keepdim=True)
@@ -51,6 +274,30 @@ def rescale_noise_cfg(noise_cfg, noise_pred_text, guidance_rescale=0.0):
     return noise_cfg
 
 
+class GuidanceSchedule:
+    # Decides which UNet branches run at each sampling step:
+    #   'cfg'    positive and negative pass
+    #   'reuse'  positive pass, negative prediction reused from the last 'cfg' step
+    #   'cond'   positive pass only, no guidance
+    # cfg_interval: (t_min, t_max), guidance is only applied to timesteps inside it
+    # uncond_reuse_steps: after each negative pass, reuse it for this many steps
+    # cond_only_after: fraction of the steps after which only the positive pass runs
+
+    def __init__(self, cfg_interval=None, uncond_reuse_steps=0, cond_only_after=None):
+        self.cfg_interval = cfg_interval
+        self.uncond_reuse_steps = int(uncond_reuse_steps)
+        self.cond_only_after = cond_only_after
+
+    def __call__(self, i, t, steps):
+        if self.cond_only_after is not None and i >= int(round(self.cond_only_after * steps)):
+            return 'cond'
+        if self.cfg_interval is not None and not (self.cfg_interval[0] <= t <= self.cfg_interval[1]):
+            return 'cond'
+        if self.uncond_reuse_steps > 0 and i % (self.uncond_reuse_steps + 1) != 0:
+            return 'reuse'
+        return 'cfg'
+
+
 class SamplerDynamicTSNR(torch.nn.Module):
     @torch.no_grad()
     def __init__(self, unet, terminal_scale=0.7):
@@ -60,26 +307,23 @@ class SamplerDynamicTSNR(torch.nn.Module):
         self.is_v = True
         self.n_timestep = 1000
         self.guidance_rescale = 0.7
+        self.terminal_scale = terminal_scale
 
-        linear_start = 0.00085
-        linear_end = 0.012
+        self.last_negative = None
+        self.generators = None
+        self.unet_passes = 0
+        self.batched_cfg_oom_shapes = set()
+        self.kv_cache = None
+        self.last_kv_cache_stats = None
+        self.last_deep_cache_stats = None
 
-        betas = np.linspace(linear_start ** 0.5, linear_end ** 0.5, self.n_timestep, dtype=np.float64) ** 2
-        betas = rescale_zero_terminal_snr(betas)
-        alphas = 1. - betas
-
-        alphas_cumprod = np.cumprod(alphas, axis=0)
+        alphas_cumprod, scale_arr = get_dynamic_tsnr_schedule(self.n_timestep, terminal_scale)
 
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod).to(unet.device))
         self.register_buffer('sqrt_alphas_cumprod', to_torch(np.sqrt(alphas_cumprod)).to(unet.device))
         self.register_buffer('sqrt_one_minus_alphas_cumprod', to_torch(np.sqrt(1. - alphas_cumprod)).to(unet.device))
 
         # Dynamic TSNR
-        turning_step = 400
-        scale_arr = np.concatenate([
-            np.linspace(1.0, terminal_scale, turning_step),
-            np.full(self.n_timestep - turning_step, terminal_scale)
-        ])
         self.register_buffer('scale_arr', to_torch(scale_arr).to(unet.device))
 
     def predict_eps_from_z_and_v(self, x_t, t, v):
@@ -107,71 +351,335 @@ class SamplerDynamicTSNR(torch.nn.Module):
         return xt, target
 
     def get_uniform_trailing_steps(self, steps):
-        c = self.n_timestep / steps
-        ddim_timesteps = np.flip(np.round(np.arange(self.n_timestep, 0, -c))).astype(np.int64)
-        steps_out = ddim_timesteps - 1
+        steps_out = get_uniform_trailing_timesteps(steps, self.n_timestep)
         return torch.tensor(steps_out, device=self.unet.device, dtype=torch.long)
 
     @torch.no_grad()
-    def forward(self, latent_shape, steps, extra_args, progress_tqdm=None):
-        bar = tqdm if progress_tqdm is None else progress_tqdm
+    def forward(self, *args, cross_attention_kv_cache=False, deep_cache=None, **kwargs):
+        # cross_attention_kv_cache: compute the K/V of the text and image contexts once per run and cfg branch,
+        # the cache is dropped when the run ends
+        # deep_cache: a DeepFeatureCache, reuses the deep UNet features on the partial steps of its schedule
+        if not cross_attention_kv_cache and deep_cache is None:
+            return self.sample(*args, **kwargs)
+
+        kv_cache = CrossAttentionKVCache() if cross_attention_kv_cache else None
+        if kv_cache is not None:
+            set_cross_attention_kv_cache(self.unet, kv_cache)
+            self.kv_cache = kv_cache
+        if deep_cache is not None:
+            self.unet.deep_cache = deep_cache
+        try:
+            return self.sample(*args, **kwargs)
+        finally:
+            if kv_cache is not None:
+                set_cross_attention_kv_cache(self.unet, None)
+                self.kv_cache = None
+                self.last_kv_cache_stats = kv_cache.stats()
+                kv_cache.clear()
+            if deep_cache is not None:
+                self.unet.deep_cache = None
+                self.last_deep_cache_stats = deep_cache.stats()
+                deep_cache.step = None
+                deep_cache.clear()
+
+    def size_kv_cache(self, condition_sets):
+        # each branch of each prepared condition set has its own entries, so the run never evicts its own
+        if self.kv_cache is not None:
+            branches = sum(len([b for b in ['positive', 'negative', 'batched'] if b in c]) for c in condition_sets)
+            self.kv_cache.max_entries_per_module = max(self.kv_cache.max_entries_per_module, branches)
+        return
+
+    def set_step(self, i):
+        # the step index of a DeepFeatureCache schedule
+        deep_cache = getattr(self.unet, 'deep_cache', None)
+        if deep_cache is not None:
+            deep_cache.step = i
+        return
+
+    @torch.no_grad()
+    def sample(self, latent_shape, steps, extra_args, progress_tqdm=None, guidance_schedule=None, batched_cfg=True,
+                solver='ddim', eta=1.0, coarse_extra_args=None, coarse_fraction=0.0, noise=None,
+                temporal_windows=None, prepare_conditions=True, generators=None):
+        assert solver in ['ddim', 'dpmpp_2m', 'dpmpp_3m', 'unipc']
+
+        # generators: one per sample, for the per-step noise of the DDIM and multistep loops
+        self.last_negative = None
+        self.unet_passes = 0
+        self.generators = generators
+
+        extra_args = self.prepare_extra_args(extra_args, batched_cfg, prepare_conditions)
 
-        eta = 1.0
+        if coarse_extra_args is not None and coarse_fraction > 0:
+            assert solver == 'ddim', 'Coarse-to-fine sampling only supports the DDIM loop.'
 
-        timesteps = self.get_uniform_trailing_steps(steps)
-        timesteps_prev = torch.nn.functional.pad(timesteps[:-1], pad=(1, 0))
+            coarse_extra_args = self.prepare_extra_args(coarse_extra_args, batched_cfg, prepare_conditions)
+            self.size_kv_cache([extra_args, coarse_extra_args])
 
-        x = torch.randn(latent_shape, device=self.unet.device, dtype=self.unet.dtype)
+            coarse_shape = coarse_extra_args['positive']['concat_cond'].shape
+            x = torch.randn(coarse_shape, device=self.unet.device, dtype=self.unet.dtype)
+            x = self.sample_coarse_to_fine(x, latent_shape, steps, extra_args, coarse_extra_args, coarse_fraction,
+                                           progress_tqdm, guidance_schedule, eta)
+            self.last_negative = None
+            return x
 
-        alphas = self.alphas_cumprod[timesteps]
-        alphas_prev = self.alphas_cumprod[timesteps_prev]
-        scale_arr = self.scale_arr[timesteps]
-        scale_arr_prev = self.scale_arr[timesteps_prev]
+        if noise is None:
+            x = torch.randn(latent_shape, device=self.unet.device, dtype=self.unet.dtype)
+        else:
+            x = noise.to(device=self.unet.device, dtype=self.unet.dtype)
 
-        sqrt_one_minus_alphas = torch.sqrt(1 - alphas)
-        sigmas = eta * np.sqrt((1 - alphas_prev.cpu().numpy()) / (1 - alphas.cpu()) * (1 - alphas.cpu() / alphas_prev.cpu().numpy()))
+        if temporal_windows is not None:
+            assert solver == 'ddim', 'Temporal window sampling only supports the DDIM loop.'
 
+            temporal_windows = [
+                (start, end, self.prepare_extra_args(window_args, batched_cfg, prepare_conditions))
+                for start, end, window_args in temporal_windows
+            ]
+            self.size_kv_cache([window_args for _, _, window_args in temporal_windows])
+
+            x = self.sample_temporal_windows(x, steps, temporal_windows, progress_tqdm, guidance_schedule, eta)
+            self.last_negative = None
+            return x
+
+        self.size_kv_cache([extra_args])
+
+        if solver == 'ddim':
+            x = self.sample_ddim(x, steps, extra_args, progress_tqdm, guidance_schedule, eta)
+        else:
+            x = self.sample_multistep(x, steps, extra_args, progress_tqdm, guidance_schedule, solver, eta)
+
+        self.last_negative = None
+        return x
+
+    def predict_start(self, x, t, sqrt_alpha, sqrt_one_minus_alpha, guidance, extra_args):
         s_in = x.new_ones((x.shape[0]))
-        s_x = x.new_ones((x.shape[0], ) + (1, ) * (x.ndim - 1))
-        for i in bar(range(len(timesteps))):
-            index = len(timesteps) - 1 - i
-            t = timesteps[index].item()
+        model_output = self.model_apply(x, t * s_in, guidance=guidance, **extra_args)
+        return self.split_model_output(x, model_output, sqrt_alpha, sqrt_one_minus_alpha)
+
+    def split_model_output(self, x, model_output, sqrt_alpha, sqrt_one_minus_alpha):
+        if self.is_v:
+            e_t = sqrt_alpha * model_output + sqrt_one_minus_alpha * x
+            pred_x0 = sqrt_alpha * x - sqrt_one_minus_alpha * model_output
+        else:
+            e_t = model_output
+            pred_x0 = (x - sqrt_one_minus_alpha * e_t) / sqrt_alpha
+
+        return pred_x0, e_t
+
+    @torch.no_grad()
+    def sample_ddim(self, x, steps, extra_args, progress_tqdm=None, guidance_schedule=None, eta=1.0):
+        bar = tqdm if progress_tqdm is None else progress_tqdm
+
+        # all coefficients are host floats, so the loop never waits for the device
+        coefficients = get_dynamic_tsnr_step_coefficients(int(steps), self.terminal_scale, eta, self.n_timestep)
 
-            model_output = self.model_apply(x, t * s_in, **extra_args)
+        for i, (t, sqrt_alpha, sqrt_one_minus_alpha, c_x0, c_dir, c_noise) in enumerate(bar(coefficients)):
+            self.set_step(i)
+            guidance = 'cfg' if guidance_schedule is None else guidance_schedule(i, t, len(coefficients))
+            pred_x0, e_t = self.predict_start(x, t, sqrt_alpha, sqrt_one_minus_alpha, guidance, extra_args)
+            x = self.ddim_update(x, pred_x0, e_t, c_x0, c_dir, c_noise, generator=self.generators)
+
+        return x
 
-            if self.is_v:
-                e_t = self.predict_eps_from_z_and_v(x, t, model_output)
+    @torch.no_grad()
+    def sample_coarse_to_fine(self, x, latent_shape, steps, extra_args, coarse_extra_args, coarse_fraction=0.4,
+                              progress_tqdm=None, guidance_schedule=None, eta=1.0):
+        # The first coarse_fraction of the steps run on a downscaled latent with downscaled conditions.
+        # At the switch the coarse x0 prediction is upsampled and renoised to the next timestep with fresh
+        # noise, since interpolating the noisy latent itself would shrink its noise variance.
+        bar = tqdm if progress_tqdm is None else progress_tqdm
+
+        coefficients = get_dynamic_tsnr_step_coefficients(int(steps), self.terminal_scale, eta, self.n_timestep)
+        switch = min(max(int(round(coarse_fraction * len(coefficients))), 1), len(coefficients) - 1)
+
+        for i, (t, sqrt_alpha, sqrt_one_minus_alpha, c_x0, c_dir, c_noise) in enumerate(bar(coefficients)):
+            coarse = i < switch
+            self.set_step(i)
+            guidance = 'cfg' if guidance_schedule is None else guidance_schedule(i, t, len(coefficients))
+            pred_x0, e_t = self.predict_start(x, t, sqrt_alpha, sqrt_one_minus_alpha, guidance,
+                                              coarse_extra_args if coarse else extra_args)
+
+            if i == switch - 1:
+                pred_x0 = resize_latents(pred_x0, latent_shape[-2], latent_shape[-1])
+                sqrt_one_minus_alpha_prev = math.sqrt(c_dir ** 2 + c_noise ** 2)
+                x = c_x0 * pred_x0 + sqrt_one_minus_alpha_prev * torch.randn_like(pred_x0)
+                self.last_negative = None  # reused negatives are at the coarse size
             else:
-                e_t = model_output
+                x = self.ddim_update(x, pred_x0, e_t, c_x0, c_dir, c_noise, generator=self.generators)
 
-            a_prev = alphas_prev[index].item() * s_x
-            sigma_t = sigmas[index].item() * s_x
+        return x
 
-            if self.is_v:
-                pred_x0 = self.predict_start_from_z_and_v(x, t, model_output)
+    @torch.no_grad()
+    def sample_temporal_windows(self, x, steps, temporal_windows, progress_tqdm=None, guidance_schedule=None, eta=1.0):
+        # Every step denoises each (start, end, extra_args) window of the long latent on its own and blends
+        # the model outputs of overlapping frames with linear ramps, so the UNet only ever sees one window.
+        # A negative prediction can not be reused across windows, so 'reuse' steps run full cfg.
+        bar = tqdm if progress_tqdm is None else progress_tqdm
+
+        coefficients = get_dynamic_tsnr_step_coefficients(int(steps), self.terminal_scale, eta, self.n_timestep)
+        weights = [
+            torch.from_numpy(w).to(device=x.device, dtype=x.dtype)[None, None, :, None, None]
+            for w in get_temporal_window_weights([(start, end) for start, end, _ in temporal_windows])
+        ]
+
+        for i, (t, sqrt_alpha, sqrt_one_minus_alpha, c_x0, c_dir, c_noise) in enumerate(bar(coefficients)):
+            self.set_step(i)
+            guidance = 'cfg' if guidance_schedule is None else guidance_schedule(i, t, len(coefficients))
+            guidance = 'cfg' if guidance == 'reuse' else guidance
+
+            model_output = torch.zeros_like(x)
+            weight_sum = torch.zeros_like(x[:1, :1, :, :1, :1])
+            s_in = x.new_ones((x.shape[0]))
+
+            for (start, end, window_args), w in zip(temporal_windows, weights):
+                self.last_negative = None
+                o = self.model_apply(x[:, :, start:end], t * s_in, guidance=guidance, **window_args)
+                model_output[:, :, start:end] += o * w
+                weight_sum[:, :, start:end] += w
+
+            model_output = model_output / weight_sum
+            pred_x0, e_t = self.split_model_output(x, model_output, sqrt_alpha, sqrt_one_minus_alpha)
+            x = self.ddim_update(x, pred_x0, e_t, c_x0, c_dir, c_noise, generator=self.generators)
+
+        return x
+
+    @staticmethod
+    def ddim_update(x, pred_x0, e_t, c_x0, c_dir, c_noise, generator=None):
+        # dynamic rescale is folded into c_x0
+        x = c_x0 * pred_x0 + c_dir * e_t
+        if c_noise > 0:
+            if generator is None:
+                noise = torch.randn_like(x)
+            elif isinstance(generator, torch.Generator):
+                noise = torch.randn(x.shape, generator=generator, device=x.device, dtype=x.dtype)
+            else:
+                noise = randn_per_sample(x, generator)
+            x = x + c_noise * noise
+        return x
+
+    @torch.no_grad()
+    def sample_multistep(self, x, steps, extra_args, progress_tqdm=None, guidance_schedule=None, solver='dpmpp_2m',
+                         eta=0.0):
+        # DPM-Solver++ (2M/3M) and UniPC in data prediction. The data prediction of every step is
+        # the v-prediction x0 with the same dynamic rescale as the DDIM loop, so the schedule of
+        # rescale_zero_terminal_snr and scale_arr is kept. The first node has lambda = -inf, so
+        # the first step is always first order and the history only keeps finite lambdas. The last
+        # trailing step to t = 0 is a large jump in lambda, so the final steps lower their order.
+
+        bar = tqdm if progress_tqdm is None else progress_tqdm
+
+        nodes = get_dynamic_tsnr_solver_nodes(int(steps), self.terminal_scale, self.n_timestep)
+        order = 3 if solver == 'dpmpp_3m' else 2
+
+        history = []  # (lambda, denoised) of previous steps, newest first
+        unipc_previous = None
+
+        for i in bar(range(len(nodes) - 1)):
+            node, node_next = nodes[i], nodes[i + 1]
+            t, alpha, sigma, log_snr, rescale = node
+
+            self.set_step(i)
+            guidance = 'cfg' if guidance_schedule is None else guidance_schedule(i, t, len(nodes) - 1)
+            pred_x0, _ = self.predict_start(x, t, alpha, sigma, guidance, extra_args)
+            denoised = pred_x0 * rescale
+
+            if unipc_previous is not None:
+                # corrector of the previous step, with the data prediction at its result
+                x_previous, node_previous, lambdas_previous, denoised_previous, order_previous = unipc_previous
+                c_x, weights = unipc_bh2_weights(node_previous, node, lambdas_previous, order=order_previous,
+                                                 corrector=True)
+                x = c_x * x_previous + sum(w * d for w, d in zip(weights, denoised_previous[:len(weights) - 1] + [denoised]))
+
+            lambdas = [l for l, _ in history]
+            denoised_list = [denoised] + [d for _, d in history]
+            step_order = min(order, len(nodes) - 1 - i)
+
+            if solver == 'unipc':
+                c_x, weights = unipc_bh2_weights(node, node_next, lambdas, order=step_order)
+                c_noise = 0.
+                unipc_previous = (x, node, lambdas, denoised_list, step_order) if math.isfinite(log_snr) else None
             else:
-                a_t = alphas[index].item() * s_x
-                sqrt_one_minus_at = sqrt_one_minus_alphas[index].item() * s_x
-                pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+                c_x, weights, c_noise = dpm_solver_pp_weights(node, node_next, lambdas, eta=eta, order=step_order,
+                                                              midpoint=solver == 'dpmpp_2m')
 
-            # dynamic rescale
-            scale_t = scale_arr[index].item() * s_x
-            prev_scale_t = scale_arr_prev[index].item() * s_x
-            rescale = (prev_scale_t / scale_t)
-            pred_x0 = pred_x0 * rescale
+            x = c_x * x + sum(w * d for w, d in zip(weights, denoised_list))
+            if c_noise > 0:
+                noise = torch.randn_like(x) if self.generators is None else randn_per_sample(x, self.generators)
+                x = x + c_noise * noise
 
-            dir_xt = (1. - a_prev - sigma_t ** 2).sqrt() * e_t
-            noise = sigma_t * torch.randn_like(x)
-            x = a_prev.sqrt() * pred_x0 + dir_xt + noise
+            if math.isfinite(log_snr):
+                history = ([(log_snr, denoised)] + history)[:order - 1]
 
         return x
 
+    def prepare_extra_args(self, extra_args, batched_cfg=True, prepare_conditions=True):
+        # adds the stacked conditions of the batched cfg pass, then replaces the conditions of every branch
+        # with the step-invariant part of the UNet forward, computed once for the whole run
+        if batched_cfg:
+            extra_args = dict(extra_args, batched=self.stack_cfg_conditions(extra_args['positive'], extra_args['negative']))
+
+        if prepare_conditions and hasattr(self.unet, 'prepare_conditions'):
+            extra_args = dict(extra_args)
+            for branch in ['positive', 'negative', 'batched']:
+                if branch in extra_args:
+                    extra_args[branch] = self.prepare_unet_conditions(extra_args[branch])
+
+        return extra_args
+
+    def prepare_unet_conditions(self, conditions):
+        prepared = self.unet.prepare_conditions(
+            conditions['context_text'], conditions['context_img'], fs=conditions.get('fs', None),
+            frames=conditions['concat_cond'].shape[2], dtype=self.unet.dtype
+        )
+        return dict(prepared=prepared, concat_cond=conditions['concat_cond'])
+
+    @staticmethod
+    def stack_cfg_conditions(positive, negative):
+        # positive and negative conditions stacked along batch, for a single UNet pass of both branches
+        batched = {}
+        for k, v in positive.items():
+            if isinstance(v, torch.Tensor):
+                batched[k] = torch.cat([v, negative[k]], dim=0)
+            else:
+                assert v == negative[k], f'Cannot batch different non-tensor conditions for {k}.'
+                batched[k] = v
+        return batched
+
     @torch.no_grad()
-    def model_apply(self, x, t, **extra_args):
-        x = x.to(device=self.unet.device, dtype=self.unet.dtype)
-        cfg_scale = extra_args['cfg_scale']
+    def unet_apply_cfg(self, x, t, **extra_args):
+        self.unet_passes += 2
+        batched = extra_args.get('batched', None)
+        shape = tuple(x.shape)
+
+        if batched is not None and shape not in self.batched_cfg_oom_shapes:
+            try:
+                # UNet3DModel folds frames with the batch size of its input, so a 2b batch unfolds correctly
+                return self.unet(torch.cat([x, x], dim=0), torch.cat([t, t], dim=0), **batched).chunk(2, dim=0)
+            except torch.cuda.OutOfMemoryError:
+                self.batched_cfg_oom_shapes.add(shape)
+                torch.cuda.empty_cache()
+                print('Batched CFG is out of memory for', shape, ', using two passes.')
+
         p = self.unet(x, t, **extra_args['positive'])
         n = self.unet(x, t, **extra_args['negative'])
+        return p, n
+
+    @torch.no_grad()
+    def model_apply(self, x, t, guidance='cfg', **extra_args):
+        x = x.to(device=self.unet.device, dtype=self.unet.dtype)
+        cfg_scale = extra_args['cfg_scale']
+
+        if guidance == 'cfg' or (guidance == 'reuse' and self.last_negative is None):
+            p, n = self.unet_apply_cfg(x, t, **extra_args)
+            self.last_negative = n
+        else:
+            p = self.unet(x, t, **extra_args['positive'])
+            self.unet_passes += 1
+
+            if guidance == 'cond':
+                return p
+
+            n = self.last_negative
+
         o = n + cfg_scale * (p - n)
         o_better = rescale_noise_cfg(o, p, guidance_rescale=self.guidance_rescale)
         return o_better
@@ -0,0 +1,161 @@
+# content-addressed cache of VAE encodes, keyed by (image digest, resolution, VAE identity, dtype)
+# an LRU memory tier in front of an optional safetensors disk tier, both bounded in bytes
+# entries are kept on the CPU, so cached encodes never hold VRAM between the offloaded model runs
+
+import os
+import hashlib
+import threading
+import weakref
+import torch
+
+import safetensors.torch as sf
+
+from collections import OrderedDict
+
+
+model_fingerprints = weakref.WeakKeyDictionary()
+
+
+def model_fingerprint(model):
+    # stable across processes, so disk entries of the same VAE weights are found again; every tensor of the
+    # state dict is hashed, once per model
+    fingerprint = model_fingerprints.get(model, None)
+    if fingerprint is None:
+        h = hashlib.blake2b(model.__class__.__name__.encode(), digest_size=16)
+        for name, p in model.state_dict().items():
+            h.update(f'{name}|{tuple(p.shape)}|{p.dtype}'.encode())
+            h.update(p.detach().to('cpu').contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        fingerprint = h.hexdigest()
+        model_fingerprints[model] = fingerprint
+    return fingerprint
+
+
+class LatentCache:
+    def __init__(self, max_bytes=2 * 1024 ** 3, cache_dir=None, max_disk_bytes=4 * 1024 ** 3):
+        # cache_dir: folder of the safetensors disk tier, None disables it; the least recently used
+        # files are deleted when the folder grows over max_disk_bytes
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, vae, image):
+        # image: c, h, w as fed to the VAE
+        image = image.detach().to('cpu').contiguous()
+        h = hashlib.blake2b(image.view(torch.uint8).numpy().tobytes(), digest_size=20)
+        h.update(f'{tuple(image.shape)}|{image.dtype}|{model_fingerprint(vae)}|{vae.dtype}'.encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.safetensors')
+
+    def get(self, key, required=('latent', )):
+        with self.lock:
+            tensors = self.entries.get(key, None)
+            if tensors is not None and all(k in tensors for k in required):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tensors
+
+        if self.cache_dir is not None and os.path.exists(self.path(key)):
+            tensors = sf.load_file(self.path(key))
+            if all(k in tensors for k in required):
+                self.disk_hits += 1
+                os.utime(self.path(key))
+                self.put(key, tensors, write=False)
+                return tensors
+
+        self.misses += 1
+        return None
+
+    def put(self, key, tensors, write=True):
+        # copies, so a per-frame slice does not keep its whole batch alive
+        tensors = {k: v.detach().to('cpu', copy=True).contiguous() for k, v in tensors.items()}
+        size = sum(v.numel() * v.element_size() for v in tensors.values())
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.memory_bytes -= sum(v.numel() * v.element_size() for v in previous.values())
+            self.entries[key] = tensors
+            self.memory_bytes += size
+            while self.memory_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.memory_bytes -= sum(v.numel() * v.element_size() for v in evicted.values())
+
+        if write and self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = self.path(key) + '.tmp'
+            sf.save_file(tensors, temp_path)
+            os.replace(temp_path, self.path(key))
+            self.trim_disk()
+        return tensors
+
+    def trim_disk(self):
+        # deletes the least recently used files until the disk tier fits max_disk_bytes
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.safetensors'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        return
+
+    def contains(self, key, required=('latent', )):
+        with self.lock:
+            tensors = self.entries.get(key, None)
+            if tensors is not None and all(k in tensors for k in required):
+                return True
+
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return False
+
+        with sf.safe_open(self.path(key), framework='pt') as f:
+            return all(k in f.keys() for k in required)
+
+    def missing(self, vae, images, required=('latent', )):
+        # images: n, c, h, w; True when any of them would need the VAE
+        return not all(self.contains(self.key(vae, image), required) for image in images)
+
+    def encode(self, vae, images, encode_fn, required=('latent', )):
+        # images: n, c, h, w; encode_fn maps a batch of images to a dict of batched tensors,
+        # it is only called once, with the images that are not cached yet
+        keys = [self.key(vae, image) for image in images]
+        results = {k: self.get(k, required) for k in dict.fromkeys(keys)}
+        misses = [k for k, v in results.items() if v is None]
+
+        if len(misses) > 0:
+            x = torch.stack([images[keys.index(k)] for k in misses], dim=0)
+            encoded = encode_fn(x)
+            for i, k in enumerate(misses):
+                results[k] = self.put(k, {name: v[i] for name, v in encoded.items()})
+
+        return [results[k] for k in keys]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.memory_bytes = 0
+        return
+
+    def stats(self):
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, entries=len(self.entries),
+                    memory_bytes=self.memory_bytes)
+
+
+latent_cache = LatentCache()
@@ -1,6 +1,9 @@
 import os
+import json
+import math
 import torch
 import einops
+import safetensors.torch as sf
 
 from diffusers import DiffusionPipeline
 from transformers import CLIPTextModel, CLIPTokenizer
@@ -9,7 +12,65 @@ from diffusers_vdm.vae import VideoAutoencoderKL
 from diffusers_vdm.projection import Resampler
 from diffusers_vdm.unet import UNet3DModel
 from diffusers_vdm.improved_clip_vision import ImprovedCLIPVisionModelWithProjection
-from diffusers_vdm.dynamic_tsnr_sampler import SamplerDynamicTSNR
+from diffusers_vdm.dynamic_tsnr_sampler import SamplerDynamicTSNR, resize_latents, get_temporal_windows
+from diffusers_vdm.continuous_batching import ContinuousBatchingScheduler, DenoisingJob
+from diffusers_vdm.text_cache import text_embedding_cache, encode_cropped_prompts_77tokens
+from diffusers_vdm.condition_cache import ImageConditionCache
+from diffusers_vdm.latent_cache import latent_cache
+
+
+def save_latent_artifact(filename, segments, parameters=None):
+    # segments: list of (latents, vae hidden states); parameters: anything json serializable
+    # The hidden states of a segment are those of its first and last key frame. The last key frame of a
+    # segment is the first of the next one, so the hidden states are stored once per key frame.
+    tensors = {}
+    keyframes = []
+    segment_keyframes = []
+
+    def add_keyframe(hidden_states):
+        if len(keyframes) > 0 and all(torch.equal(a, b) for a, b in zip(keyframes[-1], hidden_states)):
+            return len(keyframes) - 1
+        keyframes.append(hidden_states)
+        return len(keyframes) - 1
+
+    for i, (latents, hidden_states) in enumerate(segments):
+        tensors[f'segment_{i}.latents'] = latents.detach().to('cpu').contiguous()
+        segment_keyframes.append([add_keyframe([h[:, :, :1] for h in hidden_states]),
+                                  add_keyframe([h[:, :, -1:] for h in hidden_states])])
+
+    for k, hidden_states in enumerate(keyframes):
+        for j, h in enumerate(hidden_states):
+            tensors[f'keyframe_{k}.hidden_{j}'] = h.detach().to('cpu').contiguous()
+
+    metadata = dict(
+        format='latent_video_artifact',
+        version='2',
+        segments=str(len(segments)),
+        segment_keyframes=json.dumps(segment_keyframes),
+        parameters=json.dumps(parameters or {}),
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    sf.save_file(tensors, filename, metadata=metadata)
+    return filename
+
+
+def load_latent_artifact(filename, device='cpu'):
+    tensors = sf.load_file(filename, device=str(device))
+    with sf.safe_open(filename, framework='pt') as f:
+        metadata = f.metadata()
+
+    assert metadata.get('format', None) == 'latent_video_artifact', f'{filename} is not a latent video artifact.'
+    assert metadata.get('version', None) == '2', f'Unsupported latent video artifact version in {filename}.'
+
+    segments = []
+    hidden_count = sum(k.startswith('keyframe_0.hidden_') for k in tensors)
+    for i, (first, last) in enumerate(json.loads(metadata['segment_keyframes'])):
+        hidden_states = [torch.cat([tensors[f'keyframe_{first}.hidden_{j}'], tensors[f'keyframe_{last}.hidden_{j}']], dim=2)
+                         for j in range(hidden_count)]
+        segments.append((tensors[f'segment_{i}.latents'], hidden_states))
+
+    return segments, json.loads(metadata['parameters'])
 
 
 class LatentVideoDiffusionPipeline(DiffusionPipeline):
@@ -28,6 +89,11 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
         for k, v in self.loading_components.items():
             setattr(self, k, v)
 
+        self.samplers = {}
+        self.text_cache = text_embedding_cache
+        self.image_cond_cache = ImageConditionCache()
+        self.latent_cache = latent_cache
+
         if fp16:
             self.vae.half()
             self.text_encoder.half()
@@ -77,15 +143,30 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
             eval=eval
         )
 
+    def get_sampler(self, terminal_scale=0.7):
+        sampler = self.samplers.get(terminal_scale, None)
+        if sampler is None or sampler.unet is not self.unet:
+            sampler = SamplerDynamicTSNR(self.unet, terminal_scale=terminal_scale)
+            self.samplers[terminal_scale] = sampler
+        return sampler.to(self.unet.device)
+
+    def get_continuous_batching_scheduler(self, max_batch_size=4):
+        return ContinuousBatchingScheduler(self.get_sampler(), max_batch_size=max_batch_size)
+
+    @torch.inference_mode()
+    def make_denoising_job(self, steps=50, seed=0, eta=1.0, **kwargs):
+        # kwargs as for prepare_sampler_kwargs
+        latent_shape, sampler_kwargs = self.prepare_sampler_kwargs(**kwargs)
+        return DenoisingJob(latent_shape, steps, sampler_kwargs, seed=seed, eta=eta)
+
     @torch.inference_mode()
     def encode_cropped_prompt_77tokens(self, prompt: str):
-        cond_ids = self.tokenizer(prompt,
-                                  padding="max_length",
-                                  max_length=self.tokenizer.model_max_length,
-                                  truncation=True,
-                                  return_tensors="pt").input_ids.to(self.text_encoder.device)
-        cond = self.text_encoder(cond_ids, attention_mask=None).last_hidden_state
-        return cond
+        return self.encode_cropped_prompts_77tokens([prompt])[0]
+
+    @torch.inference_mode()
+    def encode_cropped_prompts_77tokens(self, prompts):
+        # cached, and all misses go through the text encoder in one batch
+        return encode_cropped_prompts_77tokens(self.tokenizer, self.text_encoder, prompts, cache=self.text_cache)
 
     @torch.inference_mode()
     def encode_clip_vision(self, frames):
@@ -95,17 +176,44 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
         clipvision_embed = einops.rearrange(clipvision_embed, '(b t) d c -> b t d c', t=t)
         return clipvision_embed
 
+    @torch.inference_mode()
+    def encode_image_cond(self, frames):
+        # CLIP vision + Resampler of the input frames and of black frames, cached per frame and per resolution
+        return self.image_cond_cache.encode_image_cond(self, frames)
+
+    @torch.inference_mode()
+    def encode_latents_uncached(self, x, return_hidden_states=True):
+        # (b t) c h w -> latent and encoder hidden states of every frame
+        x = x.to(device=self.vae.device, dtype=self.vae.dtype)
+        encoder_posterior, hidden_states = self.vae.encode(x, return_hidden_states=return_hidden_states)
+        results = dict(latent=encoder_posterior.mode() * self.vae.scale_factor)
+        if return_hidden_states:
+            results.update({f'hidden_{i}': h for i, h in enumerate(hidden_states)})
+        return results
+
+    def latents_missing(self, videos, return_hidden_states=True):
+        x = einops.rearrange(videos, 'b c t h w -> (b t) c h w').to(dtype=self.vae.dtype)
+        return self.latent_cache.missing(self.vae, x, required=('latent', 'hidden_0') if return_hidden_states else ('latent', ))
+
     @torch.inference_mode()
     def encode_latents(self, videos, return_hidden_states=True):
+        # frames are encoded independently, so every frame is cached on its own
         b, c, t, h, w = videos.shape
-        x = einops.rearrange(videos, 'b c t h w -> (b t) c h w')
-        encoder_posterior, hidden_states = self.vae.encode(x, return_hidden_states=return_hidden_states)
-        z = encoder_posterior.mode() * self.vae.scale_factor
+        x = einops.rearrange(videos, 'b c t h w -> (b t) c h w').to(dtype=self.vae.dtype)
+        frames = self.latent_cache.encode(
+            self.vae, x,
+            lambda misses: self.encode_latents_uncached(misses, return_hidden_states=return_hidden_states),
+            required=('latent', 'hidden_0') if return_hidden_states else ('latent', )
+        )
+
+        z = torch.stack([f['latent'] for f in frames], dim=0).to(self.vae.device)
         z = einops.rearrange(z, '(b t) c h w -> b c t h w', b=b, t=t)
 
         if not return_hidden_states:
             return z
 
+        hidden_states = [torch.stack([f[f'hidden_{i}'] for f in frames], dim=0).to(self.vae.device)
+                         for i in range(sum(k.startswith('hidden_') for k in frames[0]))]
         hidden_states = [einops.rearrange(h, '(b t) c h w -> b c t h w', b=b) for h in hidden_states]
         hidden_states = [h[:, :, [0, -1], :, :] for h in hidden_states]  # only need first and last
 
@@ -116,15 +224,21 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
         B, C, T, H, W = latents.shape
         latents = einops.rearrange(latents, 'b c t h w -> (b t) c h w')
         latents = latents.to(device=self.vae.device, dtype=self.vae.dtype) / self.vae.scale_factor
+        hidden_states = [h.to(device=self.vae.device, dtype=self.vae.dtype) for h in hidden_states]
         pixels = self.vae.decode(latents, ref_context=hidden_states, timesteps=T)
         pixels = einops.rearrange(pixels, '(b t) c h w -> b c t h w', b=B, t=T)
         return pixels
 
     @torch.inference_mode()
-    def __call__(
+    def decode_latent_artifact(self, filename):
+        # decode only, no sampling: returns the pixels of every segment and the generation parameters
+        segments, parameters = load_latent_artifact(filename)
+        return [self.decode_latents(latents, hidden_states) for latents, hidden_states in segments], parameters
+
+    @torch.inference_mode()
+    def prepare_sampler_kwargs(
             self,
             batch_size: int = 1,
-            steps: int = 50,
             guidance_scale: float = 5.0,
             positive_text_cond = None,
             negative_text_cond = None,
@@ -132,16 +246,9 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
             negative_image_cond = None,
             concat_cond = None,
             fs = 3,
-            progress_tqdm = None,
     ):
-        unet_is_training = self.unet.training
-
-        if unet_is_training:
-            self.unet.eval()
-
         device = self.unet.device
         dtype = self.unet.dtype
-        dynamic_tsnr_model = SamplerDynamicTSNR(self.unet)
 
         # Batch
 
@@ -154,7 +261,7 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
         if isinstance(fs, torch.Tensor):
             fs = fs.repeat(batch_size, ).to(dtype=torch.long, device=device)  # b
         else:
-            fs = torch.tensor([fs] * batch_size, dtype=torch.long, device=device)  # b
+            fs = torch.tensor([fs] * concat_cond.shape[0], dtype=torch.long, device=device)  # b
 
         # Initial latents
 
@@ -178,9 +285,144 @@ class LatentVideoDiffusionPipeline(DiffusionPipeline):
             )
         )
 
+        return latent_shape, sampler_kwargs
+
+    def estimate_max_batch_size(self, latent_shape, batched_cfg=True, bytes_per_latent_element=24 * 1024,
+                                reserved_bytes=1024 ** 3):
+        # Rough peak UNet activation memory per sample, proportional to the latent size: about 3.75 GB
+        # for one 16x40x64 fp16 sample. Calibrate bytes_per_latent_element with torch.cuda.max_memory_allocated.
+        device = self.unet.device
+        if device.type != 'cuda':
+            return 1
+
+        free_bytes, _ = torch.cuda.mem_get_info(device)
+        sample_bytes = bytes_per_latent_element * math.prod(latent_shape[1:]) * (2 if batched_cfg else 1)
+        return max(1, int((free_bytes - reserved_bytes) // sample_bytes))
+
+    @staticmethod
+    def make_generators(seeds, device):
+        # one generator per sample for its initial and per-step noise, so a sample does not depend on its batch
+        return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
+
+    @staticmethod
+    def make_noise(latent_shape, generators, device, dtype):
+        return torch.cat([
+            torch.randn((1, ) + tuple(latent_shape[1:]), generator=generator, device=device, dtype=dtype)
+            for generator in generators
+        ], dim=0)
+
+    def get_coarse_latent_size(self, height, width, scale=0.5):
+        # the UNet halves the latent at every level but the last, so sizes stay divisible by that
+        multiple = 2 ** (len(self.unet.channel_mult) - 1)
+        height = max(multiple, int(round(height * scale / multiple)) * multiple)
+        width = max(multiple, int(round(width * scale / multiple)) * multiple)
+        return height, width
+
+    def prepare_coarse_sampler_kwargs(self, sampler_kwargs, scale=0.5):
+        # text and image conditions are resolution free, only concat_cond follows the latent
+        concat_cond = sampler_kwargs['positive']['concat_cond']
+        height, width = self.get_coarse_latent_size(concat_cond.shape[-2], concat_cond.shape[-1], scale)
+        coarse_concat_cond = resize_latents(concat_cond, height, width)
+
+        coarse_sampler_kwargs = dict(sampler_kwargs)
+        for branch in ['positive', 'negative']:
+            coarse_sampler_kwargs[branch] = dict(sampler_kwargs[branch], concat_cond=coarse_concat_cond)
+
+        return coarse_sampler_kwargs
+
+    def prepare_temporal_windows(self, sampler_kwargs, window=16, overlap=4):
+        # Conditions of each window of a latent longer than the UNet's temporal length: concat_cond is
+        # sliced, and so is the image cond when it has one entry per frame. An image cond of window
+        # length is shared by every window.
+        frames = sampler_kwargs['positive']['concat_cond'].shape[2]
+        windows = []
+
+        for start, end in get_temporal_windows(frames, window=window, overlap=overlap):
+            window_kwargs = dict(sampler_kwargs)
+            for branch in ['positive', 'negative']:
+                cond = dict(sampler_kwargs[branch])
+                cond['concat_cond'] = cond['concat_cond'][:, :, start:end]
+                if cond['context_img'].shape[1] == frames:
+                    cond['context_img'] = cond['context_img'][:, start:end]
+                window_kwargs[branch] = cond
+            windows.append((start, end, window_kwargs))
+
+        return windows
+
+    @torch.inference_mode()
+    def __call__(
+            self,
+            batch_size: int = 1,
+            steps: int = 50,
+            guidance_scale: float = 5.0,
+            positive_text_cond = None,
+            negative_text_cond = None,
+            positive_image_cond = None,
+            negative_image_cond = None,
+            concat_cond = None,
+            fs = 3,
+            progress_tqdm = None,
+            guidance_schedule = None,
+            batched_cfg = True,
+            solver = 'ddim',
+            eta = 1.0,
+            coarse_fraction = 0.0,
+            coarse_scale = 0.5,
+            seeds = None,
+            window_overlap = 4,
+            cross_attention_kv_cache = False,
+            deep_cache = None,
+    ):
+        unet_is_training = self.unet.training
+
+        if unet_is_training:
+            self.unet.eval()
+
+        dynamic_tsnr_model = self.get_sampler()
+
+        latent_shape, sampler_kwargs = self.prepare_sampler_kwargs(
+            batch_size=batch_size,
+            guidance_scale=guidance_scale,
+            positive_text_cond=positive_text_cond,
+            negative_text_cond=negative_text_cond,
+            positive_image_cond=positive_image_cond,
+            negative_image_cond=negative_image_cond,
+            concat_cond=concat_cond,
+            fs=fs,
+        )
+
+        # Initial and per-step noise, from one generator per sample when seeds are given
+
+        noise, generators = None, None
+        if seeds is not None:
+            assert len(seeds) == latent_shape[0], 'Need one seed per sample.'
+            assert coarse_fraction == 0, 'Seeds are not supported with coarse-to-fine sampling.'
+            generators = self.make_generators(seeds, self.unet.device)
+            noise = self.make_noise(latent_shape, generators, self.unet.device, self.unet.dtype)
+
+        # Sliding temporal windows when the latent is longer than the UNet's temporal length
+
+        temporal_windows = None
+        window = self.image_projection.video_length
+        if latent_shape[2] > window:
+            assert coarse_fraction == 0, 'Coarse-to-fine sampling is not supported with temporal windows.'
+            temporal_windows = self.prepare_temporal_windows(sampler_kwargs, window=window, overlap=window_overlap)
+
+        # Coarse-to-fine: the first coarse_fraction of the steps at coarse_scale of the latent size
+
+        coarse_sampler_kwargs = None
+        if coarse_fraction > 0:
+            coarse_sampler_kwargs = self.prepare_coarse_sampler_kwargs(sampler_kwargs, scale=coarse_scale)
+
         # Sample
 
-        results = dynamic_tsnr_model(latent_shape, steps, extra_args=sampler_kwargs, progress_tqdm=progress_tqdm)
+        results = dynamic_tsnr_model(latent_shape, steps, extra_args=sampler_kwargs, progress_tqdm=progress_tqdm,
+                                     guidance_schedule=guidance_schedule, batched_cfg=batched_cfg,
+                                     solver=solver, eta=eta, coarse_extra_args=coarse_sampler_kwargs,
+                                     coarse_fraction=coarse_fraction, noise=noise, generators=generators,
+                                     temporal_windows=temporal_windows,
+                                     cross_attention_kv_cache=cross_attention_kv_cache,
+                                     deep_cache=deep_cache)
 
         if unet_is_training:
             self.unet.train()
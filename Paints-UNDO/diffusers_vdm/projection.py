@@ -9,6 +9,7 @@ import einops
 import torch.nn as nn
 
 from huggingface_hub import PyTorchModelHubMixin
+from diffusers_vdm.attention_backend import attention
 
 
 class ImageProjModel(nn.Module):
@@ -87,12 +88,10 @@ class PerceiverAttention(nn.Module):
         k = reshape_tensor(k, self.heads)
         v = reshape_tensor(v, self.heads)
 
-        # attention
-        scale = 1 / math.sqrt(math.sqrt(self.dim_head))
-        weight = (q * scale) @ (k * scale).transpose(-2, -1) # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        out = weight @ v
-        
+        # attention, the backends scale before the matmul or compute the softmax in float, both stable with f16
+        out = attention(q.flatten(0, 1), k.flatten(0, 1), v.flatten(0, 1), 'resampler', scale=1 / math.sqrt(self.dim_head))
+        out = out.unflatten(0, (b, self.heads))
+
         out = out.permute(0, 2, 1, 3).reshape(b, l, -1)
 
         return self.to_out(out)
@@ -0,0 +1,124 @@
+# producer/consumer pipeline of processing stages connected by bounded queues, with a timeline of
+# when each stage worked on which item, so idle gaps between stages can be compared
+
+import time
+import queue
+import threading
+
+
+class StagePipeline:
+    def __init__(self, stages, queue_size=1, threaded=True):
+        # stages: list of (name, fn), each fn maps the output of the previous stage to its own output
+        # threaded=False runs every item through all stages in sequence, as the baseline of the report
+        self.stages = stages
+        self.queue_size = queue_size
+        self.threaded = threaded
+        self.events = []
+        self.lock = threading.Lock()
+        self.begin_time = None
+        self.end_time = None
+
+    def record(self, name, index, begin, end):
+        with self.lock:
+            self.events.append((name, index, begin - self.begin_time, end - self.begin_time))
+        return
+
+    def run_stage(self, name, fn, index, item):
+        begin = time.perf_counter()
+        result = fn(item)
+        self.record(name, index, begin, time.perf_counter())
+        return result
+
+    def run(self, items):
+        self.events = []
+        self.begin_time = time.perf_counter()
+
+        if self.threaded:
+            results = self.run_threaded(list(items))
+        else:
+            results = []
+            for index, item in enumerate(items):
+                for name, fn in self.stages:
+                    item = self.run_stage(name, fn, index, item)
+                results.append(item)
+
+        self.end_time = time.perf_counter()
+        return results
+
+    def run_threaded(self, items):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        errors = []
+        done = object()
+
+        def worker(stage_index):
+            name, fn = self.stages[stage_index]
+            source, target = queues[stage_index], queues[stage_index + 1]
+            while True:
+                entry = source.get()
+                if entry is done:
+                    target.put(done)
+                    return
+                index, item = entry
+                if errors:
+                    continue  # drain, so upstream stages never block
+                try:
+                    target.put((index, self.run_stage(name, fn, index, item)))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(i, ), daemon=True) for i in range(len(self.stages))]
+        for thread in threads:
+            thread.start()
+
+        def feed():
+            for entry in enumerate(items):
+                queues[0].put(entry)
+            queues[0].put(done)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+        results = [None] * len(items)
+        while True:
+            entry = queues[-1].get()
+            if entry is done:
+                break
+            index, item = entry
+            results[index] = item
+
+        for thread in threads + [feeder]:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    def timeline(self):
+        # per stage: busy seconds, idle seconds between its first start and the end, and utilization
+        total = self.end_time - self.begin_time
+        report = dict(seconds=total, stages={})
+        for name, _ in self.stages:
+            spans = sorted((begin, end) for n, _, begin, end in self.events if n == name)
+            busy = sum(end - begin for begin, end in spans)
+            gaps = [b - e for (_, e), (b, _) in zip(spans[:-1], spans[1:])]
+            report['stages'][name] = dict(
+                busy=busy,
+                first_start=spans[0][0] if spans else None,
+                idle_gaps=sum(gaps),
+                utilization=busy / max(total, 1e-8),
+            )
+        return report
+
+    def format_timeline(self, width=60):
+        # one text row per stage, showing the index of the item the stage was working on
+        total = max(self.end_time - self.begin_time, 1e-8)
+        lines = [f'{total:.2f}s total, {"threaded" if self.threaded else "sequential"}']
+        for name, _ in self.stages:
+            row = [' '] * width
+            for n, index, begin, end in self.events:
+                if n == name:
+                    for c in range(int(begin / total * width), max(int(end / total * width), int(begin / total * width) + 1)):
+                        row[min(c, width - 1)] = str(index % 10)
+            lines.append(f'{name:>12} |{"".join(row)}|')
+        return '\n'.join(lines)
@@ -0,0 +1,127 @@
+# LRU cache of prompt embeddings, keyed by (text encoder identity, prompt)
+# shared by every prompt encoder, so repeated prompts (and the empty negative) skip the text encoder
+
+import weakref
+import threading
+import torch
+
+from collections import OrderedDict
+
+
+class TextEmbeddingCache:
+    def __init__(self, capacity=64, host_capacity=0):
+        # capacity: embeddings kept where the text encoder produced them
+        # host_capacity: embeddings evicted from the first tier are kept in host memory, 0 disables the tier
+        self.capacity = capacity
+        self.host_capacity = host_capacity
+
+        self.entries = OrderedDict()
+        self.host_entries = OrderedDict()
+        self.encoders = {}
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text_encoder, prompt):
+        encoder_id = id(text_encoder)
+        encoder_ref = self.encoders.get(encoder_id, None)
+
+        if encoder_ref is None or encoder_ref() is not text_encoder:
+            # a new encoder, or a new one at the address of a collected one
+            self.drop(encoder_id)
+            self.encoders[encoder_id] = weakref.ref(text_encoder, lambda _, i=encoder_id: self.drop(i))
+
+        return encoder_id, prompt
+
+    def drop(self, encoder_id):
+        with self.lock:
+            self.encoders.pop(encoder_id, None)
+            for entries in [self.entries, self.host_entries]:
+                for k in [k for k in entries if k[0] == encoder_id]:
+                    del entries[k]
+        return
+
+    def get(self, text_encoder, prompt):
+        k = self.key(text_encoder, prompt)
+        with self.lock:
+            if k in self.entries:
+                self.entries.move_to_end(k)
+                return self.entries[k]
+            if k in self.host_entries:
+                return self.host_entries[k]
+        return None
+
+    def put(self, text_encoder, prompt, embedding):
+        k = self.key(text_encoder, prompt)
+        with self.lock:
+            self.host_entries.pop(k, None)
+            self.entries[k] = embedding
+            self.entries.move_to_end(k)
+
+            while len(self.entries) > self.capacity:
+                evicted_key, evicted = self.entries.popitem(last=False)
+                if self.host_capacity > 0:
+                    self.host_entries[evicted_key] = evicted.to('cpu')
+
+            while len(self.host_entries) > self.host_capacity:
+                self.host_entries.popitem(last=False)
+        return
+
+    def missing(self, text_encoder, prompts):
+        return [p for p in dict.fromkeys(prompts) if self.get(text_encoder, p) is None]
+
+    def encode(self, text_encoder, prompts, encode_fn, device=None):
+        # encode_fn maps a list of prompts to a batch of embeddings, it is only called once, with all misses
+        misses = self.missing(text_encoder, prompts)
+
+        self.misses += len(misses)
+        self.hits += len(prompts) - len(misses)
+
+        if len(misses) > 0:
+            embeddings = encode_fn(misses)
+            for prompt, embedding in zip(misses, embeddings.chunk(len(misses), dim=0)):
+                self.put(text_encoder, prompt, embedding)
+
+        results = [self.get(text_encoder, p) for p in prompts]
+
+        if device is not None:
+            results = [r.to(device) for r in results]
+
+        return results
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.host_entries.clear()
+        return
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self.entries),
+            host_entries=len(self.host_entries),
+        )
+
+
+text_embedding_cache = TextEmbeddingCache()
+
+
+def tokenize_and_encode_77tokens(tokenizer, text_encoder, prompts):
+    cond_ids = tokenizer(prompts,
+                         padding="max_length",
+                         max_length=tokenizer.model_max_length,
+                         truncation=True,
+                         return_tensors="pt").input_ids.to(device=text_encoder.device)
+    return text_encoder(cond_ids, attention_mask=None).last_hidden_state
+
+
+def encode_cropped_prompts_77tokens(tokenizer, text_encoder, prompts, cache=None, device=None):
+    # one text encoder forward for all prompts that are not cached yet
+    cache = text_embedding_cache if cache is None else cache
+    return cache.encode(
+        text_encoder, list(prompts),
+        lambda misses: tokenize_and_encode_77tokens(tokenizer, text_encoder, misses),
+        device=device
+    )
@@ -0,0 +1,69 @@
+# token merging (ToMe) for the spatial self attention, after "Token Merging for Fast Stable Diffusion"
+# The tokens of every frame are split into destinations, one per sy x sx cell of the image, and sources, the
+# rest. The r sources most similar to a destination are averaged into it before attention, and every merged
+# token is copied back to its sources after, so the rest of the block still sees (h w) tokens.
+
+import torch
+
+
+def identity(x):
+    return x
+
+
+def destination_indices(h, w, sx, sy, device):
+    # token indices of the destinations (top-left of each cell) first, then of the sources
+    is_source = torch.ones(h, w, dtype=torch.int64, device=device)
+    is_source[:h // sy * sy:sy, :w // sx * sx:sx] = 0
+    order = is_source.flatten().argsort(stable=True)
+    num_dst = (h // sy) * (w // sx)
+    return order[:num_dst], order[num_dst:]
+
+
+def bipartite_soft_matching(metric, h, w, ratio, sx=2, sy=2):
+    # metric: (b, h w, c), the tokens the similarity is measured on; returns merge and unmerge functions
+    # for tensors of the same (b, h w, ...) layout
+    b, n, _ = metric.shape
+    r = int(n * ratio)
+
+    if r <= 0 or h < sy or w < sx:
+        return identity, identity
+
+    with torch.no_grad():
+        dst_idx, src_idx = destination_indices(h, w, sx, sy, metric.device)
+        r = min(r, src_idx.shape[0])
+
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        scores = metric[:, src_idx] @ metric[:, dst_idx].transpose(-1, -2)
+
+        # each source goes to its most similar destination; only the r best matched sources are merged
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        merged = edge_idx[:, :r]
+        unmerged = edge_idx[:, r:]
+        merged_dst = node_idx.gather(dim=-1, index=merged)
+
+        # token positions in the (h w) sequence
+        merged_pos = src_idx[merged]
+        unmerged_pos = src_idx[unmerged]
+
+    def gather(x, index):
+        return x.gather(dim=1, index=index[..., None].expand(-1, -1, x.shape[-1]))
+
+    def merge(x):
+        dst = x[:, dst_idx]
+        dst = dst.scatter_reduce(1, merged_dst[..., None].expand(-1, -1, x.shape[-1]), gather(x, merged_pos),
+                                 reduce='mean')
+        return torch.cat([gather(x, unmerged_pos), dst], dim=1)
+
+    def unmerge(x):
+        c = x.shape[-1]
+        unmerged_len = unmerged_pos.shape[1]
+        unm, dst = x[:, :unmerged_len], x[:, unmerged_len:]
+
+        out = x.new_empty(b, n, c)
+        out[:, dst_idx] = dst
+        out.scatter_(1, unmerged_pos[..., None].expand(-1, -1, c), unm)
+        out.scatter_(1, merged_pos[..., None].expand(-1, -1, c), gather(dst, merged_dst))
+        return out
+
+    return merge, unmerge
@@ -16,12 +16,30 @@ from diffusers_vdm.basics import (
     conv_nd,
     linear,
     avg_pool_nd,
-    normalization
+    normalization,
+    folded_group_norm,
+    folded_temporal_conv
 )
 from diffusers_vdm.attention import SpatialTransformer, TemporalTransformer
 from huggingface_hub import PyTorchModelHubMixin
 
 
+timestep_freqs = {}
+
+
+def get_timestep_freqs(dim, max_period, device):
+    # the frequency table only depends on dim, so it is built once per device
+    key = (dim, max_period, str(device))
+    freqs = timestep_freqs.get(key, None)
+    if freqs is None:
+        half = dim // 2
+        freqs = torch.exp(
+            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
+        ).to(device=device)
+        timestep_freqs[key] = freqs
+    return freqs
+
+
 def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     """
     Create sinusoidal timestep embeddings.
@@ -32,10 +50,7 @@ def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     :return: an [N x dim] Tensor of positional embeddings.
     """
     if not repeat_only:
-        half = dim // 2
-        freqs = torch.exp(
-            -math.log(max_period) * torch.arange(start=0, end=half, dtype=torch.float32) / half
-        ).to(device=timesteps.device)
+        freqs = get_timestep_freqs(dim, max_period, timesteps.device)
         args = timesteps[:, None].float() * freqs[None]
         embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
         if dim % 2:
@@ -45,6 +60,50 @@ def timestep_embedding(timesteps, dim, max_period=10000, repeat_only=False):
     return embedding
 
 
+class DeepFeatureCache:
+    # DeepCache-style reuse of the deep UNet features across sampling steps. On a full step the UNet runs
+    # completely and keeps the input of its last `branch` output blocks; on a partial step it only runs the
+    # first `branch` input blocks and those output blocks on the kept features. A step is full when it is in
+    # full_steps, or when the kept features of its call are `interval` or more steps old (or missing).
+    # Entries are keyed by the prepared conditions of each call, so cfg branches and temporal windows keep
+    # their own; the sampler sets `step` before every step, and without it every pass is full.
+
+    def __init__(self, interval=3, branch=1, full_steps=()):
+        self.interval = int(interval)
+        self.branch = int(branch)
+        self.full_steps = set(full_steps)
+        self.step = None
+        self.entries = {}
+        self.full_passes = 0
+        self.partial_passes = 0
+
+    def get(self, key, shape):
+        entry = self.entries.get(id(key), None)
+        if self.step is None or self.step in self.full_steps or entry is None or entry[0] is not key \
+                or entry[1] != shape or not 0 < self.step - entry[2] < self.interval:
+            self.full_passes += 1
+            return None
+
+        self.partial_passes += 1
+        return entry[3]
+
+    def put(self, key, shape, features):
+        if self.step is not None:
+            self.entries[id(key)] = (key, shape, self.step, features)
+        return
+
+    def memory_bytes(self):
+        return sum(entry[3].numel() * entry[3].element_size() for entry in self.entries.values())
+
+    def clear(self):
+        self.entries.clear()
+        return
+
+    def stats(self):
+        return dict(full_passes=self.full_passes, partial_passes=self.partial_passes,
+                    entries=len(self.entries), memory_bytes=self.memory_bytes())
+
+
 class TimestepBlock(nn.Module):
     """
     Any module where forward() takes timestep embeddings as a second argument.
@@ -63,12 +122,17 @@ class TimestepEmbedSequential(nn.Sequential, TimestepBlock):
     support it as an extra input.
     """
 
+    # set by UNet3DModel.enable_inference_layout
+    inference_layout = False
+
     def forward(self, x, emb, context=None, batch_size=None):
         for layer in self:
             if isinstance(layer, TimestepBlock):
                 x = layer(x, emb, batch_size=batch_size)
             elif isinstance(layer, SpatialTransformer):
                 x = layer(x, context)
+            elif isinstance(layer, TemporalTransformer) and self.inference_layout and not torch.is_grad_enabled():
+                x = layer.forward_folded(x, context, batch_size)
             elif isinstance(layer, TemporalTransformer):
                 x = rearrange(x, '(b f) c h w -> b c f h w', b=batch_size)
                 x = layer(x, context)
@@ -153,6 +217,9 @@ class ResBlock(TimestepBlock):
     :param use_image_dataset: if True, the temporal parameters will not be optimized.
     """
 
+    # set by UNet3DModel.enable_inference_layout
+    inference_layout = False
+
     def __init__(
             self,
             channels,
@@ -259,7 +326,10 @@ class ResBlock(TimestepBlock):
             h = self.out_layers(h)
         h = self.skip_connection(x) + h
 
-        if self.use_temporal_conv and batch_size:
+        if self.use_temporal_conv and batch_size and self.inference_layout and not torch.is_grad_enabled() \
+                and self.temopral_conv.foldable:
+            h = self.temopral_conv.forward_folded(h, batch_size)
+        elif self.use_temporal_conv and batch_size:
             h = rearrange(h, '(b t) c h w -> b c t h w', b=batch_size)
             h = self.temopral_conv(h)
             h = rearrange(h, 'b c t h w -> (b t) c h w')
@@ -300,6 +370,9 @@ class TemporalConvBlock(nn.Module):
         nn.init.zeros_(self.conv4[-1].weight)
         nn.init.zeros_(self.conv4[-1].bias)
 
+        # only kernels that mix nothing but frames can run on the (b t) c h w layout
+        self.foldable = not spatial_aware
+
     def forward(self, x):
         identity = x
         x = self.conv1(x)
@@ -309,6 +382,19 @@ class TemporalConvBlock(nn.Module):
 
         return identity + x
 
+    def forward_folded(self, x, batch_size):
+        # same as forward on the (b c t h w) video, with x and the result stored as (b t) c h w
+        identity = x
+        for layer in [*self.conv1, *self.conv2, *self.conv3, *self.conv4]:
+            if isinstance(layer, nn.GroupNorm):
+                x = folded_group_norm(layer, x, batch_size)
+            elif isinstance(layer, nn.Conv3d):
+                x = folded_temporal_conv(layer, x, batch_size)
+            else:
+                x = layer(x)
+
+        return identity + x
+
 
 class UNet3DModel(nn.Module, PyTorchModelHubMixin):
     """
@@ -394,6 +480,9 @@ class UNet3DModel(nn.Module, PyTorchModelHubMixin):
         self.image_cross_attention_scale_learnable = image_cross_attention_scale_learnable
         self.default_fs = default_fs
         self.fs_condition = fs_condition
+        self.inference_layout = False
+        self.skip_buffers = {}
+        self.deep_cache = None
 
         ## Time embedding blocks
         self.time_embed = nn.Sequential(
@@ -588,16 +677,41 @@ class UNet3DModel(nn.Module, PyTorchModelHubMixin):
     def dtype(self):
         return next(self.parameters()).dtype
 
-    def forward(self, x, timesteps, context_text=None, context_img=None, concat_cond=None, fs=None, **kwargs):
+    def prepare_conditions(self, context_text, context_img, fs=None, frames=16, dtype=None):
+        # Everything of forward that does not depend on the timestep. Samplers build it once per run
+        # and pass it as `prepared`, so every step only computes the timestep embedding.
+        b = context_text.shape[0]
+        dtype = self.dtype if dtype is None else dtype
+
+        context_text = context_text.repeat_interleave(repeats=frames, dim=0)
+        context_img = rearrange(context_img, 'b t l c -> (b t) l c')
+
+        fs_embed = None
+        if self.fs_condition:
+            if fs is None:
+                fs = torch.tensor(
+                    [self.default_fs] * b, dtype=torch.long, device=context_text.device)
+            fs_emb = timestep_embedding(fs, self.model_channels, repeat_only=False).type(dtype)
+
+            fs_embed = self.fps_embedding(fs_emb)
+            fs_embed = fs_embed.repeat_interleave(repeats=frames, dim=0)
+
+        return dict(context=(context_text, context_img), fs_embed=fs_embed, batch_size=b, frames=frames)
+
+    def forward(self, x, timesteps, context_text=None, context_img=None, concat_cond=None, fs=None, prepared=None,
+                **kwargs):
         b, _, t, _, _ = x.shape
+        cache_key = context_text if prepared is None else prepared
+
+        if prepared is None:
+            prepared = self.prepare_conditions(context_text, context_img, fs=fs, frames=t, dtype=x.dtype)
+
+        assert prepared['batch_size'] == b and prepared['frames'] == t, 'Prepared conditions do not match the input.'
 
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False).type(x.dtype)
         emb = self.time_embed(t_emb)
 
-        context_text = context_text.repeat_interleave(repeats=t, dim=0)
-        context_img = rearrange(context_img, 'b t l c -> (b t) l c')
-
-        context = (context_text, context_img)
+        context = prepared['context']
 
         emb = emb.repeat_interleave(repeats=t, dim=0)
 
@@ -608,28 +722,43 @@ class UNet3DModel(nn.Module, PyTorchModelHubMixin):
         x = rearrange(x, 'b c t h w -> (b t) c h w')
 
         ## combine emb
-        if self.fs_condition:
-            if fs is None:
-                fs = torch.tensor(
-                    [self.default_fs] * b, dtype=torch.long, device=x.device)
-            fs_emb = timestep_embedding(fs, self.model_channels, repeat_only=False).type(x.dtype)
+        if prepared['fs_embed'] is not None:
+            emb = emb + prepared['fs_embed']
 
-            fs_embed = self.fps_embedding(fs_emb)
-            fs_embed = fs_embed.repeat_interleave(repeats=t, dim=0)
-            emb = emb + fs_embed
+        skip_buffers = self.inference_layout and not torch.is_grad_enabled()
+
+        # with a deep feature cache, partial steps stop after the shallow input blocks and resume at the
+        # matching output blocks with the deep features kept by the last full step
+        deep_cache = None if torch.is_grad_enabled() else self.deep_cache
+        deep_features = None if deep_cache is None else deep_cache.get(cache_key, x.shape)
+        resume = len(self.output_blocks) if deep_cache is None else len(self.output_blocks) - deep_cache.branch
 
         h = x
         hs = []
         for id, module in enumerate(self.input_blocks):
+            if deep_features is not None and id == deep_cache.branch:
+                break
             h = module(h, emb, context=context, batch_size=b)
             if id == 0 and self.addition_attention:
                 h = self.init_attn(h, emb, context=context, batch_size=b)
-            hs.append(h)
+            hs.append(self.skip_buffer(len(self.output_blocks) - 1 - id, h) if skip_buffers else h)
 
-        h = self.middle_block(h, emb, context=context, batch_size=b)
-
-        for module in self.output_blocks:
-            h = torch.cat([h, hs.pop()], dim=1)
+        if deep_features is None:
+            h = self.middle_block(h, emb, context=context, batch_size=b)
+        else:
+            h = deep_features
+
+        for index, module in enumerate(self.output_blocks):
+            if deep_features is not None and index < resume:
+                continue
+            if deep_cache is not None and deep_features is None and index == resume:
+                deep_cache.put(cache_key, x.shape, h)
+            if skip_buffers:
+                buffer = hs.pop()
+                buffer[:, :h.shape[1]].copy_(h)
+                h = buffer
+            else:
+                h = torch.cat([h, hs.pop()], dim=1)
             h = module(h, emb, context=context, batch_size=b)
         h = h.type(x.dtype)
         y = self.out(h)
@@ -637,6 +766,47 @@ class UNet3DModel(nn.Module, PyTorchModelHubMixin):
         y = rearrange(y, '(b t) c h w -> b c t h w', b=b)
         return y
 
+    def skip_buffer(self, index, skip):
+        # The input of output block `index` is [h, skip] on channels. The skip is copied into the back of a buffer
+        # kept across steps, and the output pass only copies h into its front instead of allocating the cat.
+        # There is one buffer per block, replaced when the batch shape changes (cfg fallback, batching).
+        channels = self.output_blocks[index][0].channels
+        shape = (skip.shape[0], channels, *skip.shape[2:])
+
+        buffer = self.skip_buffers.pop(index, None)
+        if buffer is None or buffer.shape != shape or buffer.dtype != skip.dtype or buffer.device != skip.device:
+            del buffer
+            buffer = torch.empty(shape, dtype=skip.dtype, device=skip.device)
+        self.skip_buffers[index] = buffer
+        buffer[:, channels - skip.shape[1]:].copy_(skip)
+        return buffer
+
+    def enable_inference_layout(self, enable=True):
+        # Inference without grad: temporal layers work on the (b t) c h w layout of the spatial ones instead of
+        # rearranging around every call, and the skip concatenations use buffers kept across steps.
+        # Disabling releases the buffers.
+        self.inference_layout = enable
+        for m in self.modules():
+            if isinstance(m, (TimestepEmbedSequential, ResBlock)):
+                m.inference_layout = enable
+        self.skip_buffers.clear()
+        return
+
+    def set_token_merging(self, ratios=None):
+        # ratios: downsample rate -> fraction of the tokens merged before the spatial self attention at that
+        # rate, e.g. {1: 0.5, 2: 0.25}; inference only, None turns merging off
+        ratios = ratios or {}
+        ds = 1
+        for block in [*self.input_blocks, self.middle_block, *self.output_blocks]:
+            for layer in block:
+                if isinstance(layer, SpatialTransformer):
+                    layer.token_merge_ratio = float(ratios.get(ds, 0.0))
+                elif isinstance(layer, Downsample) or (isinstance(layer, ResBlock) and isinstance(layer.h_upd, Downsample)):
+                    ds *= 2
+                elif isinstance(layer, Upsample) or (isinstance(layer, ResBlock) and isinstance(layer.h_upd, Upsample)):
+                    ds //= 2
+        return
+
     def enable_gradient_checkpointing(self, enable=True, verbose=False):
         for k, v in self.named_modules():
             if hasattr(v, 'checkpoint'):
@@ -1,5 +1,8 @@
 import os
 import cv2
+import time
+import queue
+import threading
 import torch
 import einops
 import torchvision
@@ -17,7 +20,7 @@ def resize_and_center_crop(image, target_width, target_height, interpolation=cv2
     return cropped_image
 
 
-def save_bcthw_as_mp4(x, output_filename, fps=10):
+def bcthw_to_thwc_uint8(x):
     b, c, t, h, w = x.shape
 
     per_row = b
@@ -26,14 +29,117 @@ def save_bcthw_as_mp4(x, output_filename, fps=10):
             per_row = p
             break
 
-    os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
     x = torch.clamp(x.float(), -1., 1.) * 127.5 + 127.5
     x = x.detach().cpu().to(torch.uint8)
     x = einops.rearrange(x, '(m n) c t h w -> t (m h) (n w) c', n=per_row)
+    return x
+
+
+def save_bcthw_as_mp4(x, output_filename, fps=10):
+    os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
+    x = bcthw_to_thwc_uint8(x)
     torchvision.io.write_video(output_filename, x, fps=fps, video_codec='h264', options={'crf': '1'})
     return x
 
 
+class StreamingMP4Writer:
+    # Encodes bcthw segments to a fragmented mp4 on a background thread as they arrive, so the file is
+    # playable while it grows and each segment's frames can be released right after write().
+    # Same codec and crf as save_bcthw_as_mp4; a fragment is closed at every key frame, every gop_size frames.
+
+    def __init__(self, output_filename, fps=10, crf=1, gop_size=16, max_queued_segments=2):
+        os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
+
+        self.output_filename = output_filename
+        self.fps = fps
+        self.crf = crf
+        self.gop_size = gop_size
+
+        self.queue = queue.Queue(maxsize=max_queued_segments)
+        self.container = None
+        self.stream = None
+        self.error = None
+
+        self.frames_written = 0
+        self.begin_time = time.perf_counter()
+        self.first_frame_seconds = None
+
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def write(self, x):
+        # x: b, c, t, h, w in [-1, 1]; returns the uint8 frames that are queued for encoding
+        if self.error is not None:
+            raise self.error
+        x = bcthw_to_thwc_uint8(x)
+        self.queue.put(x.numpy())
+        return x
+
+    def open(self, height, width):
+        import av
+
+        self.container = av.open(self.output_filename, mode='w', format='mp4',
+                                 options={'movflags': 'frag_keyframe+empty_moov+default_base_moof'})
+        self.stream = self.container.add_stream('h264', rate=self.fps)
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = 'yuv420p'
+        self.stream.codec_context.gop_size = self.gop_size
+        self.stream.options = {'crf': str(self.crf)}
+        return
+
+    def encode(self, frames):
+        import av
+
+        if self.container is None:
+            self.open(frames.shape[1], frames.shape[2])
+
+        for frame in frames:
+            for packet in self.stream.encode(av.VideoFrame.from_ndarray(frame, format='rgb24')):
+                self.mux(packet)
+            self.frames_written += 1
+        return
+
+    def mux(self, packet):
+        # the encoder lookahead holds frames back, so short jobs may only get packets when flushing
+        self.container.mux(packet)
+        if self.first_frame_seconds is None:
+            self.first_frame_seconds = time.perf_counter() - self.begin_time
+        return
+
+    def worker(self):
+        while True:
+            frames = self.queue.get()
+            if frames is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so write() never blocks on a dead encoder
+            try:
+                self.encode(frames)
+            except Exception as e:
+                self.error = e
+
+        if self.container is not None:
+            try:
+                for packet in self.stream.encode():
+                    self.mux(packet)
+                self.container.close()
+            except Exception as e:
+                self.error = self.error or e
+        return
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return dict(
+            frames=self.frames_written,
+            first_frame_seconds=self.first_frame_seconds,
+            seconds=time.perf_counter() - self.begin_time,
+        )
+
+
 def save_bcthw_as_png(x, output_filename):
     os.makedirs(os.path.dirname(os.path.abspath(os.path.realpath(output_filename))), exist_ok=True)
     x = torch.clamp(x.float(), -1., 1.) * 127.5 + 127.5
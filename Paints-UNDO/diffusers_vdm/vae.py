@@ -3,38 +3,17 @@
 
 
 import torch
-import xformers.ops
 import torch.nn as nn
 
 from einops import rearrange, repeat
 from diffusers_vdm.basics import default, exists, zero_module, conv_nd, linear, normalization
 from diffusers_vdm.unet import Upsample, Downsample
+from diffusers_vdm.attention_backend import attention
 from huggingface_hub import PyTorchModelHubMixin
 
 
-def chunked_attention(q, k, v, batch_chunk=0):
-    # if batch_chunk > 0 and not torch.is_grad_enabled():
-    #     batch_size = q.size(0)
-    #     chunks = [slice(i, i + batch_chunk) for i in range(0, batch_size, batch_chunk)]
-    #
-    #     out_chunks = []
-    #     for chunk in chunks:
-    #         q_chunk = q[chunk]
-    #         k_chunk = k[chunk]
-    #         v_chunk = v[chunk]
-    #
-    #         out_chunk = torch.nn.functional.scaled_dot_product_attention(
-    #             q_chunk, k_chunk, v_chunk, attn_mask=None
-    #         )
-    #         out_chunks.append(out_chunk)
-    #
-    #     out = torch.cat(out_chunks, dim=0)
-    # else:
-    #     out = torch.nn.functional.scaled_dot_product_attention(
-    #         q, k, v, attn_mask=None
-    #     )
-    out = xformers.ops.memory_efficient_attention(q, k, v)
-    return out
+def chunked_attention(q, k, v, batch_chunk=0, shape_class='vae'):
+    return attention(q, k, v, shape_class)
 
 
 def nonlinearity(x):
@@ -339,7 +318,7 @@ class AttentionCombiner(nn.Module):
         )
 
         out = chunked_attention(
-            q, k, v, batch_chunk=1
+            q, k, v, batch_chunk=1, shape_class='vae_combiner'
         )
 
         if exists(mask):
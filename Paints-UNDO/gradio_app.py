@@ -3,6 +3,8 @@ import os
 os.environ['HF_HOME'] = os.path.join(os.path.dirname(__file__), 'hf_download')
 result_dir = os.path.join('./', 'results')
 os.makedirs(result_dir, exist_ok=True)
+# folder of the latent cache disk tier, e.g. os.path.join('./', 'latent_cache'); None keeps encodes in memory only
+latent_cache_dir = None
 
 
 import functools
@@ -22,8 +24,11 @@ from diffusers_helper.k_diffusion import KDiffusionSampler
 from diffusers import AutoencoderKL, UNet2DConditionModel
 from diffusers.models.attention_processor import AttnProcessor2_0
 from transformers import CLIPTextModel, CLIPTokenizer
-from diffusers_vdm.pipeline import LatentVideoDiffusionPipeline
-from diffusers_vdm.utils import resize_and_center_crop, save_bcthw_as_mp4
+from diffusers_vdm.pipeline import LatentVideoDiffusionPipeline, save_latent_artifact, load_latent_artifact
+from diffusers_vdm.utils import resize_and_center_crop, save_bcthw_as_mp4, StreamingMP4Writer
+from diffusers_vdm.text_cache import text_embedding_cache, encode_cropped_prompts_77tokens
+from diffusers_vdm.latent_cache import latent_cache
+from diffusers_vdm.stage_pipeline import StagePipeline
 
 
 class ModifiedUNet(UNet2DConditionModel):
@@ -54,6 +59,8 @@ memory_management.unload_all_models([
     unet, vae, text_encoder
 ])
 
+latent_cache.cache_dir = latent_cache_dir
+
 k_sampler = KDiffusionSampler(
     unet=unet,
     timesteps=1000,
@@ -76,14 +83,21 @@ def find_best_bucket(h, w, options):
 
 @torch.inference_mode()
 def encode_cropped_prompt_77tokens(txt: str):
-    memory_management.load_models_to_gpu(text_encoder)
-    cond_ids = tokenizer(txt,
-                         padding="max_length",
-                         max_length=tokenizer.model_max_length,
-                         truncation=True,
-                         return_tensors="pt").input_ids.to(device=text_encoder.device)
-    text_cond = text_encoder(cond_ids, attention_mask=None).last_hidden_state
-    return text_cond
+    return encode_cropped_prompts(tokenizer, text_encoder, [txt])[0]
+
+
+@torch.inference_mode()
+def encode_cropped_prompts(tokenizer, text_encoder, txts):
+    # cached prompts skip the text encoder and its move to GPU
+    if text_embedding_cache.missing(text_encoder, txts):
+        memory_management.load_models_to_gpu(text_encoder)
+    return encode_cropped_prompts_77tokens(tokenizer, text_encoder, txts)
+
+
+@torch.inference_mode()
+def vae_encode(x):
+    x = x.to(device=vae.device, dtype=vae.dtype)
+    return dict(latent=vae.encode(x).latent_dist.mode() * vae.config.scaling_factor)
 
 
 @torch.inference_mode()
@@ -117,35 +131,53 @@ def interrogator_process(x):
 
 @torch.inference_mode()
 def process(input_fg, prompt, input_undo_steps, image_width, image_height, seed, steps, n_prompt, cfg,
-            progress=gr.Progress()):
+            chain_strength=1.0, progress=gr.Progress()):
     rng = torch.Generator(device=memory_management.gpu).manual_seed(int(seed))
 
-    memory_management.load_models_to_gpu(vae)
     fg = resize_and_center_crop(input_fg, image_width, image_height)
-    concat_conds = numpy2pytorch([fg]).to(device=vae.device, dtype=vae.dtype)
-    concat_conds = vae.encode(concat_conds).latent_dist.mode() * vae.config.scaling_factor
+    concat_conds = numpy2pytorch([fg]).to(dtype=vae.dtype)
+    if latent_cache.missing(vae, concat_conds):
+        memory_management.load_models_to_gpu(vae)
+    concat_conds = latent_cache.encode(vae, concat_conds, vae_encode)[0]['latent'][None].to(memory_management.gpu)
 
-    memory_management.load_models_to_gpu(text_encoder)
-    conds = encode_cropped_prompt_77tokens(prompt)
-    unconds = encode_cropped_prompt_77tokens(n_prompt)
+    conds, unconds = encode_cropped_prompts(tokenizer, text_encoder, [prompt, n_prompt])
 
     memory_management.load_models_to_gpu(unet)
+    conds, unconds = conds.to(unet.device), unconds.to(unet.device)
     fs = torch.tensor(input_undo_steps).to(device=unet.device, dtype=torch.long)
     initial_latents = torch.zeros_like(concat_conds)
     concat_conds = concat_conds.to(device=unet.device, dtype=unet.dtype)
-    latents = k_sampler(
-        initial_latent=initial_latents,
-        strength=1.0,
-        num_inference_steps=steps,
-        guidance_scale=cfg,
-        batch_size=len(input_undo_steps),
-        generator=rng,
-        prompt_embeds=conds,
-        negative_prompt_embeds=unconds,
-        cross_attention_kwargs={'concat_conds': concat_conds, 'coded_conds': fs},
-        same_noise_in_batch=True,
-        progress_tqdm=functools.partial(progress.tqdm, desc='Generating Key Frames')
-    ).to(vae.dtype) / vae.config.scaling_factor
+
+    if chain_strength < 1.0:
+        # smallest operation step first, every later one warm-started from the previous key frame
+        order = sorted(range(len(input_undo_steps)), key=lambda i: input_undo_steps[i])
+        latents, _ = k_sampler.chain(
+            initial_latent=initial_latents,
+            cross_attention_kwargs_list=[{'concat_conds': concat_conds, 'coded_conds': fs[i:i + 1]} for i in order],
+            num_inference_steps=steps,
+            chain_strength=chain_strength,
+            seed=seed,
+            guidance_scale=cfg,
+            prompt_embeds=conds,
+            negative_prompt_embeds=unconds,
+            progress_tqdm=functools.partial(progress.tqdm, desc='Generating Key Frames (Chained)')
+        )
+        latents = latents[torch.tensor(order).argsort()]
+        latents = latents.to(vae.dtype) / vae.config.scaling_factor
+    else:
+        latents = k_sampler(
+            initial_latent=initial_latents,
+            strength=1.0,
+            num_inference_steps=steps,
+            guidance_scale=cfg,
+            batch_size=len(input_undo_steps),
+            generator=rng,
+            prompt_embeds=conds,
+            negative_prompt_embeds=unconds,
+            cross_attention_kwargs={'concat_conds': concat_conds, 'coded_conds': fs},
+            same_noise_in_batch=True,
+            progress_tqdm=functools.partial(progress.tqdm, desc='Generating Key Frames')
+        ).to(vae.dtype) / vae.config.scaling_factor
 
     memory_management.load_models_to_gpu(vae)
     pixels = vae.decode(latents).sample
@@ -156,87 +188,275 @@ def process(input_fg, prompt, input_undo_steps, image_width, image_height, seed,
 
 
 @torch.inference_mode()
-def process_video_inner(image_1, image_2, prompt, seed=123, steps=25, cfg_scale=7.5, fs=3, progress_tqdm=None):
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    torch.cuda.manual_seed_all(seed)
+def sample_video_segments(image_pairs, prompt, seeds, steps=25, cfg_scale=7.5, fs=3, progress_tqdm=None):
+    # All segments of a job sampled together: each model is loaded once per stage, and segments of the
+    # same bucket share UNet passes, in chunks sized by a memory estimate. Segment i draws all of its noise
+    # from a generator seeded with seeds[i], so its result does not depend on the chunk it is sampled in.
 
     frames = 16
+    segments = []
 
-    target_height, target_width = find_best_bucket(
-        image_1.shape[0], image_1.shape[1],
-        options=[(320, 512), (384, 448), (448, 384), (512, 320)]
-    )
-
-    image_1 = resize_and_center_crop(image_1, target_width=target_width, target_height=target_height)
-    image_2 = resize_and_center_crop(image_2, target_width=target_width, target_height=target_height)
-    input_frames = numpy2pytorch([image_1, image_2])
-    input_frames = input_frames.unsqueeze(0).movedim(1, 2)
-
-    memory_management.load_models_to_gpu(video_pipe.text_encoder)
-    positive_text_cond = video_pipe.encode_cropped_prompt_77tokens(prompt)
-    negative_text_cond = video_pipe.encode_cropped_prompt_77tokens("")
-
-    memory_management.load_models_to_gpu([video_pipe.image_projection, video_pipe.image_encoder])
-    input_frames = input_frames.to(device=video_pipe.image_encoder.device, dtype=video_pipe.image_encoder.dtype)
-    positive_image_cond = video_pipe.encode_clip_vision(input_frames)
-    positive_image_cond = video_pipe.image_projection(positive_image_cond)
-    negative_image_cond = video_pipe.encode_clip_vision(torch.zeros_like(input_frames))
-    negative_image_cond = video_pipe.image_projection(negative_image_cond)
-
-    memory_management.load_models_to_gpu([video_pipe.vae])
-    input_frames = input_frames.to(device=video_pipe.vae.device, dtype=video_pipe.vae.dtype)
-    input_frame_latents, vae_hidden_states = video_pipe.encode_latents(input_frames, return_hidden_states=True)
-    first_frame = input_frame_latents[:, :, 0]
-    last_frame = input_frame_latents[:, :, 1]
-    concat_cond = torch.stack([first_frame] + [torch.zeros_like(first_frame)] * (frames - 2) + [last_frame], dim=2)
+    for image_1, image_2 in image_pairs:
+        target_height, target_width = find_best_bucket(
+            image_1.shape[0], image_1.shape[1],
+            options=[(320, 512), (384, 448), (448, 384), (512, 320)]
+        )
+        image_1 = resize_and_center_crop(image_1, target_width=target_width, target_height=target_height)
+        image_2 = resize_and_center_crop(image_2, target_width=target_width, target_height=target_height)
+        input_frames = numpy2pytorch([image_1, image_2])
+        segments.append(dict(image_1=image_1, image_2=image_2, input_frames=input_frames.unsqueeze(0).movedim(1, 2)))
+
+    positive_text_cond, negative_text_cond = encode_cropped_prompts(
+        video_pipe.tokenizer, video_pipe.text_encoder, [prompt, ""])
+
+    if any(video_pipe.image_cond_cache.missing(video_pipe, s['input_frames']) for s in segments):
+        memory_management.load_models_to_gpu([video_pipe.image_projection, video_pipe.image_encoder])
+    for s in segments:
+        s['positive_image_cond'], s['negative_image_cond'] = video_pipe.encode_image_cond(s['input_frames'])
+
+    if any(video_pipe.latents_missing(s['input_frames']) for s in segments):
+        memory_management.load_models_to_gpu([video_pipe.vae])
+    for s in segments:
+        input_frame_latents, s['vae_hidden_states'] = video_pipe.encode_latents(s['input_frames'], return_hidden_states=True)
+        first_frame = input_frame_latents[:, :, 0]
+        last_frame = input_frame_latents[:, :, 1]
+        s['concat_cond'] = torch.stack([first_frame] + [torch.zeros_like(first_frame)] * (frames - 2) + [last_frame], dim=2)
+
+    groups = {}
+    for i, s in enumerate(segments):
+        groups.setdefault(tuple(s['concat_cond'].shape), []).append(i)
 
     memory_management.load_models_to_gpu([video_pipe.unet])
-    latents = video_pipe(
-        batch_size=1,
-        steps=int(steps),
-        guidance_scale=cfg_scale,
-        positive_text_cond=positive_text_cond,
-        negative_text_cond=negative_text_cond,
-        positive_image_cond=positive_image_cond,
-        negative_image_cond=negative_image_cond,
-        concat_cond=concat_cond,
-        fs=fs,
-        progress_tqdm=progress_tqdm
-    )
 
-    memory_management.load_models_to_gpu([video_pipe.vae])
-    video = video_pipe.decode_latents(latents, vae_hidden_states)
-    return video, image_1, image_2
+    for shape, indices in groups.items():
+        chunk_size = video_pipe.estimate_max_batch_size(shape)
+        for begin in range(0, len(indices), chunk_size):
+            chunk = indices[begin:begin + chunk_size]
+            results = video_pipe(
+                batch_size=1,
+                steps=int(steps),
+                guidance_scale=cfg_scale,
+                positive_text_cond=positive_text_cond.repeat(len(chunk), 1, 1),
+                negative_text_cond=negative_text_cond.repeat(len(chunk), 1, 1),
+                positive_image_cond=torch.cat([segments[i]['positive_image_cond'] for i in chunk], dim=0),
+                negative_image_cond=torch.cat([segments[i]['negative_image_cond'] for i in chunk], dim=0),
+                concat_cond=torch.cat([segments[i]['concat_cond'] for i in chunk], dim=0),
+                fs=fs,
+                progress_tqdm=progress_tqdm,
+                seeds=[seeds[i] for i in chunk]
+            )
+            for i, result in zip(chunk, results.chunk(len(chunk), dim=0)):
+                segments[i]['latents'] = result
+
+    return segments
+
+
+def process_video_overlapped(image_pairs, prompt, seeds, output_filename, fps, steps=25, cfg_scale=7.5, fs=3,
+                             threaded=None, preview_filename=None, progress_tqdm=None):
+    # Chunks of segments through preprocess -> encode -> sample -> decode stages on their own threads, so the
+    # CPU work and encodes of the next chunk and the decode and write of the previous one overlap with
+    # sampling. Segments go last to first, the order in which the reversed video is written, and consecutive
+    # segments of one bucket are sampled in one batch, as in sample_video_segments. Each GPU stage issues its
+    # work on its own CUDA stream. Overlap needs every model resident, so it defaults to high_vram;
+    # threaded=False gives the sequential baseline.
+    threaded = memory_management.high_vram if threaded is None else threaded
+    frames = 16
+    buckets = [(320, 512), (384, 448), (448, 384), (512, 320)]
+
+    if threaded:
+        memory_management.load_models_to_gpu([video_pipe.text_encoder, video_pipe.image_encoder,
+                                              video_pipe.image_projection, video_pipe.vae, video_pipe.unet])
+
+    def load(models):
+        if not threaded:
+            memory_management.load_models_to_gpu(models)
+        return
+
+    def on_stream(fn):
+        # The stage waits for its stream before handing its results on, and keeps the tensors of its input
+        # alive until then, so the allocator never reuses them while the stream still reads them.
+        stream = torch.cuda.Stream(device=memory_management.gpu) if threaded and torch.cuda.is_available() else None
+
+        def run(chunk):
+            if stream is None:
+                return fn(chunk)
+            inputs = [dict(s) for s in chunk]
+            stream.wait_stream(torch.cuda.default_stream(memory_management.gpu))
+            with torch.cuda.stream(stream):
+                result = fn(chunk)
+            stream.synchronize()
+            del inputs
+            return result
+
+        return run
+
+    # the sample batch is sized before any stage runs, with headroom for the encode and decode in flight
+    chunks = []
+    for i in reversed(range(len(image_pairs))):
+        bucket = find_best_bucket(image_pairs[i][0].shape[0], image_pairs[i][0].shape[1], options=buckets)
+        if len(chunks) > 0 and chunks[-1][0] == bucket and len(chunks[-1][1]) < chunks[-1][2]:
+            chunks[-1][1].append(i)
+        else:
+            latent_shape = (1, 4, frames, bucket[0] // 8, bucket[1] // 8)
+            chunks.append((bucket, [i], max(1, video_pipe.estimate_max_batch_size(latent_shape) // 2)))
+
+    def preprocess(chunk):
+        (target_height, target_width), indices, _ = chunk
+        segments = []
+        for i in indices:
+            image_1, image_2 = image_pairs[i]
+            image_1 = resize_and_center_crop(image_1, target_width=target_width, target_height=target_height)
+            image_2 = resize_and_center_crop(image_2, target_width=target_width, target_height=target_height)
+            if i == 0 and preview_filename is not None:
+                Image.fromarray(image_1).save(preview_filename)
+            input_frames = numpy2pytorch([image_1, image_2]).unsqueeze(0).movedim(1, 2)
+            segments.append(dict(index=i, input_frames=input_frames))
+        return segments
+
+    @torch.inference_mode()
+    def encode(segments):
+        if text_embedding_cache.missing(video_pipe.text_encoder, [prompt, ""]):
+            load(video_pipe.text_encoder)
+        positive_text_cond, negative_text_cond = encode_cropped_prompts_77tokens(
+            video_pipe.tokenizer, video_pipe.text_encoder, [prompt, ""])
+
+        for s in segments:
+            s['positive_text_cond'], s['negative_text_cond'] = positive_text_cond, negative_text_cond
+
+            if video_pipe.image_cond_cache.missing(video_pipe, s['input_frames']):
+                load([video_pipe.image_projection, video_pipe.image_encoder])
+            s['positive_image_cond'], s['negative_image_cond'] = video_pipe.encode_image_cond(s['input_frames'])
+
+            if video_pipe.latents_missing(s['input_frames']):
+                load([video_pipe.vae])
+            input_frame_latents, s['vae_hidden_states'] = video_pipe.encode_latents(s.pop('input_frames'))
+            first_frame = input_frame_latents[:, :, 0]
+            last_frame = input_frame_latents[:, :, 1]
+            s['concat_cond'] = torch.stack([first_frame] + [torch.zeros_like(first_frame)] * (frames - 2) + [last_frame], dim=2)
+        return segments
+
+    @torch.inference_mode()
+    def sample(segments):
+        load([video_pipe.unet])
+        latents = video_pipe(
+            batch_size=1,
+            steps=int(steps),
+            guidance_scale=cfg_scale,
+            positive_text_cond=torch.cat([s.pop('positive_text_cond') for s in segments], dim=0),
+            negative_text_cond=torch.cat([s.pop('negative_text_cond') for s in segments], dim=0),
+            positive_image_cond=torch.cat([s.pop('positive_image_cond') for s in segments], dim=0),
+            negative_image_cond=torch.cat([s.pop('negative_image_cond') for s in segments], dim=0),
+            concat_cond=torch.cat([s.pop('concat_cond') for s in segments], dim=0),
+            fs=fs,
+            progress_tqdm=progress_tqdm if progress_tqdm is not None else (lambda x: x),
+            seeds=[seeds[s['index']] for s in segments]
+        )
+        for s, result in zip(segments, latents.chunk(len(segments), dim=0)):
+            s['latents'] = result
+        return segments
+
+    @torch.inference_mode()
+    def decode(segments):
+        load([video_pipe.vae])
+        video = []
+        for s in segments:
+            pixels = video_pipe.decode_latents(s.pop('latents'), s.pop('vae_hidden_states'))
+            pixels = torch.flip(pixels[:, :, :-1, :, :], dims=[2])
+            video += [x.numpy() for x in writer.write(pixels)]
+        return video
+
+    writer = StreamingMP4Writer(output_filename, fps=fps)
+    pipeline = StagePipeline([
+        ('preprocess', preprocess), ('encode', on_stream(encode)), ('sample', on_stream(sample)),
+        ('decode', on_stream(decode))
+    ], queue_size=1, threaded=threaded)
+
+    try:
+        results = pipeline.run(chunks)
+    except BaseException:
+        # stop the encoder thread; the stage error is the one to report
+        try:
+            writer.close()
+        except Exception:
+            pass
+        raise
+    writer.close()
+
+    video = [frame for chunk in results for frame in chunk]
+    return output_filename, video, pipeline.timeline()
 
 
 @torch.inference_mode()
-def process_video(keyframes, prompt, steps, cfg, fps, seed, progress=gr.Progress()):
-    result_frames = []
-    cropped_images = []
-
-    for i, (im1, im2) in enumerate(zip(keyframes[:-1], keyframes[1:])):
-        im1 = np.array(Image.open(im1[0]))
-        im2 = np.array(Image.open(im2[0]))
-        frames, im1, im2 = process_video_inner(
-            im1, im2, prompt, seed=seed + i, steps=steps, cfg_scale=cfg, fs=3,
-            progress_tqdm=functools.partial(progress.tqdm, desc=f'Generating Videos ({i + 1}/{len(keyframes) - 1})')
+def process_video(keyframes, prompt, steps, cfg, fps, seed, save_latents=False, progress=gr.Progress()):
+    image_pairs = [
+        (np.array(Image.open(im1[0])), np.array(Image.open(im2[0])))
+        for im1, im2 in zip(keyframes[:-1], keyframes[1:])
+    ]
+
+    if memory_management.high_vram and not save_latents:
+        # every model stays resident, so encodes, sampling and the decode and write of segments overlap
+        uuid_name = str(uuid.uuid4())
+        output_filename, video, _ = process_video_overlapped(
+            image_pairs, prompt, seeds=[seed + i for i in range(len(image_pairs))],
+            output_filename=os.path.join(result_dir, uuid_name + '.mp4'), fps=fps, steps=steps, cfg_scale=cfg, fs=3,
+            preview_filename=os.path.join(result_dir, uuid_name + '.png'),
+            progress_tqdm=functools.partial(progress.tqdm, desc=f'Generating Videos ({len(image_pairs)} segments)')
         )
-        result_frames.append(frames[:, :, :-1, :, :])
-        cropped_images.append([im1, im2])
+        return output_filename, video
 
-    video = torch.cat(result_frames, dim=2)
-    video = torch.flip(video, dims=[2])
+    segments = sample_video_segments(
+        image_pairs, prompt, seeds=[seed + i for i in range(len(image_pairs))], steps=steps, cfg_scale=cfg, fs=3,
+        progress_tqdm=functools.partial(progress.tqdm, desc=f'Generating Videos ({len(image_pairs)} segments)')
+    )
 
     uuid_name = str(uuid.uuid4())
     output_filename = os.path.join(result_dir, uuid_name + '.mp4')
-    Image.fromarray(cropped_images[0][0]).save(os.path.join(result_dir, uuid_name + '.png'))
-    video = save_bcthw_as_mp4(video, output_filename, fps=fps)
-    video = [x.cpu().numpy() for x in video]
+    Image.fromarray(segments[0]['image_1']).save(os.path.join(result_dir, uuid_name + '.png'))
+
+    # with save_latents, another fps or decode only costs a VAE decode later, see redecode_video
+    latents = [(s.pop('latents'), s.pop('vae_hidden_states')) for s in segments]
+    if save_latents:
+        save_latent_artifact(os.path.join(result_dir, uuid_name + '.safetensors'), latents, parameters=dict(
+            prompt=prompt, steps=int(steps), cfg=float(cfg), fps=int(fps), seeds=[seed + i for i in range(len(latents))],
+            fs=3, buckets=[list(s['image_1'].shape[:2]) for s in segments]
+        ))
+
+    video = write_video_segments(latents, output_filename, fps=fps)
     return output_filename, video
 
 
+@torch.inference_mode()
+def write_video_segments(latents, output_filename, fps):
+    # The video plays the segments backwards, so the last segment is decoded and written first, each one
+    # flipped in time. Decoded frames are handed to the writer and released segment by segment.
+    memory_management.load_models_to_gpu([video_pipe.vae])
+    writer = StreamingMP4Writer(output_filename, fps=fps)
+    video = []
+
+    while len(latents) > 0:
+        segment_latents, vae_hidden_states = latents.pop()
+        frames = video_pipe.decode_latents(segment_latents, vae_hidden_states)
+        frames = torch.flip(frames[:, :, :-1, :, :], dims=[2])
+        video += [x.numpy() for x in writer.write(frames)]
+        del frames
+
+    stats = writer.close()
+    if stats['first_frame_seconds'] is not None:
+        print(f'Wrote {stats["frames"]} frames, first fragment after {stats["first_frame_seconds"]:.2f} seconds.')
+    return video
+
+
+@torch.inference_mode()
+def redecode_video(artifact_filename, fps=None, output_filename=None):
+    # rebuilds the video of a process_video job from its latent artifact, without sampling
+    latents, parameters = load_latent_artifact(artifact_filename)
+    fps = parameters['fps'] if fps is None else fps
+    if output_filename is None:
+        output_filename = os.path.join(result_dir, str(uuid.uuid4()) + '.mp4')
+    write_video_segments(latents, output_filename, fps=fps)
+    return output_filename
+
+
 block = gr.Blocks().queue()
 with block:
     gr.Markdown('# Paints-Undo')
@@ -259,6 +479,8 @@ with block:
                 image_height = gr.Slider(label="Image Height", minimum=256, maximum=1024, value=640, step=64)
                 steps = gr.Slider(label="Steps", minimum=1, maximum=100, value=50, step=1)
                 cfg = gr.Slider(label="CFG Scale", minimum=1.0, maximum=32.0, value=3.0, step=0.01)
+                chain_strength = gr.Slider(label="Chain Strength (1.0 = independent key frames)",
+                                           minimum=0.1, maximum=1.0, value=1.0, step=0.05)
                 n_prompt = gr.Textbox(label="Negative Prompt",
                                       value='lowres, bad anatomy, bad hands, cropped, worst quality')
 
@@ -279,6 +501,7 @@ with block:
                 i2v_steps = gr.Slider(minimum=1, maximum=60, step=1, elem_id="i2v_steps",
                                       label="Sampling steps", value=50)
                 i2v_fps = gr.Slider(minimum=1, maximum=30, step=1, elem_id="i2v_motion", label="FPS", value=4)
+                i2v_save_latents = gr.Checkbox(label='Save latents for re-decoding', value=False)
             with gr.Column():
                 i2v_end_btn = gr.Button("Generate Video", interactive=False)
                 i2v_output_video = gr.Video(label="Generated Video", elem_id="output_vid", autoplay=True,
@@ -298,13 +521,14 @@ with block:
 
     key_gen_button.click(
         fn=process,
-        inputs=[input_fg, prompt, input_undo_steps, image_width, image_height, seed, steps, n_prompt, cfg],
+        inputs=[input_fg, prompt, input_undo_steps, image_width, image_height, seed, steps, n_prompt, cfg,
+                chain_strength],
         outputs=[result_gallery]
     ).then(lambda: [gr.update(interactive=True), gr.update(interactive=True), gr.update(interactive=True)],
            outputs=[prompt_gen_button, key_gen_button, i2v_end_btn])
 
     i2v_end_btn.click(
-        inputs=[result_gallery, i2v_input_text, i2v_steps, i2v_cfg_scale, i2v_fps, i2v_seed],
+        inputs=[result_gallery, i2v_input_text, i2v_steps, i2v_cfg_scale, i2v_fps, i2v_seed, i2v_save_latents],
         outputs=[i2v_output_video, i2v_output_images],
         fn=process_video
     )